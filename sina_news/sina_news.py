@@ -2,15 +2,159 @@ __author__ = 'huafeng'
 #coding:utf-8
 import re
 import os
+import sys
 import time
 import codecs
 import requests
 import datetime
-from bs4 import BeautifulSoup
+import collections
+import concurrent.futures
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from html.parser import HTMLParser
+try:
+    import lxml.html
+except ImportError:
+    lxml = None
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
 
 PATH = os.path.dirname(os.path.abspath(__file__))
+# charset sniffing is shared with the page dumps of weibo_content
+sys.path.append(os.path.join(os.path.dirname(PATH), 'weibo_content'))
+import html_core_dump
+
 TIMESTAMP = time.strftime('%Y%m%d')
 # yesterday = (datetime.datetime.now().date()+datetime.timedelta(days=-1)).strftime('%Y_%m_%d')
+FETCH_WORKERS = 8           # concurrent article downloads
+FETCH_TIMEOUT = (5, 15)     # (connect, read) seconds
+FETCH_RETRIES = 2
+FETCH_WINDOW = 64           # downloaded articles waiting to be written in order
+FETCH_HOSTS = 16            # hosts with kept-alive connections (news, finance, sports... .sina.com.cn)
+
+# extract the title (h1#artibodyTitle) and paragraphs (div#artibody p) of an
+# article, each extractor returns (title, paragraph list) and raises on a page
+# not matching the pattern
+
+def decode_html(html):
+    # same BOM and <meta> charset sniffing as the weibo_content dumps
+    return html_core_dump.HTMLTextDecoder().decode(html)
+
+# start tags closing an open p, as in the HTML parsing rules
+P_CLOSING_TAGS = {'address', 'article', 'aside', 'blockquote', 'center', 'details', 'dialog',
+                  'dir', 'div', 'dl', 'dd', 'dt', 'fieldset', 'figcaption', 'figure', 'footer',
+                  'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hgroup', 'hr', 'li',
+                  'main', 'menu', 'nav', 'ol', 'p', 'pre', 'section', 'summary', 'table', 'ul'}
+
+class ArticleParser(HTMLParser):
+    # only keeps the text of h1#artibodyTitle and the p tags inside div#artibody
+
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.title = None
+        self.paragraphs = []
+        self.in_title = False
+        self.body_level = 0     # open div tags since div#artibody, 0 outside of it
+        self.in_p = False
+        self.chunks = []
+
+    def close_p(self):
+        # a p can not contain another p or a block, its end tag is implied
+        if self.in_p:
+            self.in_p = False
+            self.paragraphs.append(''.join(self.chunks))
+
+    def handle_starttag(self, tag, attrs):
+        if self.in_p and tag in P_CLOSING_TAGS:
+            self.close_p()
+        if tag == 'h1' and self.title is None and ('id', 'artibodyTitle') in attrs:
+            self.in_title = True
+            self.chunks = []
+        elif tag == 'div':
+            if self.body_level:
+                self.body_level += 1
+            elif ('id', 'artibody') in attrs:
+                self.body_level = 1
+        elif tag == 'p' and self.body_level:
+            self.in_p = True
+            self.chunks = []
+
+    def handle_endtag(self, tag):
+        if tag == 'h1' and self.in_title:
+            self.in_title = False
+            self.title = ''.join(self.chunks)
+        elif tag == 'div' and self.body_level:
+            self.close_p()
+            self.body_level -= 1
+        elif tag == 'p' and self.body_level:
+            if not self.in_p:
+                # a stray </p> is an empty paragraph
+                self.chunks = []
+                self.in_p = True
+            self.close_p()
+
+    def handle_data(self, data):
+        if self.in_title or self.in_p:
+            self.chunks.append(data)
+
+def extract_by_htmlparser(html):
+    parser = ArticleParser()
+    parser.feed(decode_html(html))
+    parser.close()
+    if parser.title is None:
+        raise ValueError('artibodyTitle not found')
+    return (parser.title, parser.paragraphs)
+
+def extract_by_lxml(html):
+    doc = lxml.html.fromstring(html)
+    title = doc.get_element_by_id('artibodyTitle').text_content()
+    body = doc.get_element_by_id('artibody')
+    return (title, [p.text_content() for p in body.iter('p')])
+
+def extract_by_html5lib(html):
+    soup = BeautifulSoup(html, 'html5lib')
+    title = soup.find('h1', id='artibodyTitle').text
+    div_lelvel_str = soup.find('div', id='artibody')
+    return (title, [item.text for item in div_lelvel_str.find_all('p')])
+
+EXTRACTORS = {'htmlparser': extract_by_htmlparser}
+if lxml:
+    EXTRACTORS['lxml'] = extract_by_lxml
+if BeautifulSoup:
+    EXTRACTORS['html5lib'] = extract_by_html5lib
+
+# fastest available one
+extract_article = EXTRACTORS.get('lxml', extract_by_htmlparser)
+
+def create_session():
+    # keep-alive connections shared by the download threads, one pool per
+    # host, the least recently used one is closed past FETCH_HOSTS hosts;
+    # connection errors and 5xx responses are retried with backoff
+    session = requests.Session()
+    retry = Retry(total=FETCH_RETRIES, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))
+    adapter = HTTPAdapter(pool_connections=FETCH_HOSTS, pool_maxsize=FETCH_WORKERS, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def fetch_article(session, url):
+    # returns the lines to write, or the message to log on failure
+    try:
+        res = session.get(url, timeout=FETCH_TIMEOUT)
+        res.raise_for_status()
+        html = res.content
+    except BaseException:
+        return (None, 'timed out in item_url;%s\n'%url)
+    try:
+        title, p_level_list = extract_article(html)
+        item_url_info_list = [title.strip()+'\n']
+        item_url_info_list.extend([item.strip()+'\n' for item in p_level_list])
+        item_url_info_list.append("*"*40+'\n')
+    except BaseException:
+        return (None, 'div do not match pattern in item_url;%s\n'%url)
+    return (item_url_info_list, None)
 
 def read_item_url_file():
     whole_item_url_filename = os.path.join(PATH, 'sys', 'whole_item_url_%s'%TIMESTAMP)
@@ -24,32 +168,29 @@ def read_item_url_file():
     codecs.open(output_filename, mode='a', encoding='utf-8') as wf,\
     codecs.open(failed_url_filename, mode='a', encoding='utf-8')as log_f:
         url_list = [item.strip() for item in f.readlines()]
-        for url in url_list:
-            item_url_info_list = []
-            try:
-                html = requests.get(url).text.encode('ISO-8859-1')
-                splited_url = url.split('/')
-                html_filename = '+'.join(splited_url[-3:])
-                #filename = os.path.join(PATH, data_directory, html_filename)
-                #with open(filename, mode='wb') as htmlwf:
-                #   htmlwf.write(html)
-            except BaseException:
-                log_f.write('timed out in item_url;%s\n'%url)
-                continue
-            soup = BeautifulSoup(html, 'html5lib')
-            try:
-                title = soup.find('h1', id='artibodyTitle').text.strip()
-                item_url_info_list.append(title+'\n')
-                div_lelvel_str = soup.find('div', id='artibody')
-                p_level_list = div_lelvel_str.find_all('p')
-                content_list = [item.text.strip()+'\n' for item in p_level_list]
-                item_url_info_list.extend(content_list)
-                item_url_info_list.append("*"*40+'\n')
-            except BaseException:
-                log_f.write('div do not match pattern in item_url;%s\n'%url)
-                continue
-            if item_url_info_list:
+        start = time.time()
+        num_articles = 0
+        session = create_session()
+        # articles are downloaded concurrently but written in the order of
+        # url_list, at most FETCH_WINDOW of them are kept in memory
+        with session, concurrent.futures.ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+            def write_article(future):
+                item_url_info_list, message = future.result()
+                if message:
+                    log_f.write(message)
+                    return 0
                 wf.writelines(item_url_info_list)
+                return 1
+            window = collections.deque()
+            for url in url_list:
+                window.append(executor.submit(fetch_article, session, url))
+                while window and (len(window) >= FETCH_WINDOW or window[0].done()):
+                    num_articles += write_article(window.popleft())
+            while window:
+                num_articles += write_article(window.popleft())
+        minutes = max(time.time() - start, 1e-6) / 60
+        print('%d of %d articles in %.1f s, %.1f articles/min' % \
+              (num_articles, len(url_list), minutes * 60, num_articles / minutes))
 # read_item_url_file()
 def write_item_url_into_file(item_url_list):
     item_url_filename = os.path.join(PATH, 'sys', 'whole_item_url_%s'%TIMESTAMP)
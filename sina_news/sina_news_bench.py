@@ -0,0 +1,87 @@
+#coding:utf-8
+# benchmark of the article extractors in sina_news on saved article pages,
+# reports pages/s and peak memory of each one and the pages whose output
+# differs from the html5lib one (the original implementation)
+#
+# usage: python sina_news_bench.py html_dir
+#
+# each extractor runs in a fresh process so that the maximum resident size
+# is not inflated by the one before, tracemalloc is enabled in a second pass
+# only, it does not see the memory allocated by libxml2 for lxml
+import os
+import sys
+import time
+import resource
+import tracemalloc
+import concurrent.futures
+
+import sina_news
+
+def load_pages(path):
+    pages = []
+    for name in sorted(os.listdir(path)):
+        if name.endswith(('.htm', '.html', '.shtml')):
+            with open(os.path.join(path, name), 'rb') as f:
+                pages.append(f.read())
+    return pages
+
+def extract_pages(extractor, pages):
+    outputs = []
+    for html in pages:
+        try:
+            outputs.append(extractor(html))
+        except BaseException:
+            outputs.append(None)
+    return outputs
+
+def run(name, path):
+    # returns (outputs, seconds, traced peak bytes, max rss KB)
+    extractor = sina_news.EXTRACTORS[name]
+    pages = load_pages(path)
+    start = time.perf_counter()
+    outputs = extract_pages(extractor, pages)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    extract_pages(extractor, pages)
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return (outputs, elapsed, traced_peak, max_rss)
+
+def baseline(path):
+    # max rss of a process only loading the pages
+    load_pages(path)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_in_process(func, *args):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(func, *args).result()
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or not os.path.isdir(sys.argv[1]):
+        print('usage: sina_news_bench html_dir')
+        sys.exit(0)
+    path = sys.argv[1]
+    pages = load_pages(path)
+    if not pages:
+        print('Error: no page found')
+        sys.exit(1)
+    num_bytes = sum([len(p) for p in pages])
+    print('corpus: %d pages, %.2f MB' % (len(pages), num_bytes / 1048576.0))
+    base_rss = run_in_process(baseline, path)
+
+    results = {}
+    for name in ('html5lib', 'lxml', 'htmlparser'):
+        if name not in sina_news.EXTRACTORS:
+            print('%-10s not installed' % name)
+            continue
+        outputs, elapsed, traced_peak, max_rss = run_in_process(run, name, path)
+        results[name] = outputs
+        failed = len([1 for o in outputs if o is None])
+        num_diff = 0
+        if 'html5lib' in results:
+            num_diff = len([1 for a, b in zip(outputs, results['html5lib']) if a != b])
+        elapsed = max(elapsed, 1e-6)
+        print('%-10s %.1f pages/s, %.2f MB/s, traced peak %.1f KB, rss +%.1f MB, %d failed, %d differ from html5lib' % \
+              (name, len(pages) / elapsed, num_bytes / elapsed / 1048576.0, traced_peak / 1024.0,
+               (max_rss - base_rss) / 1024.0, failed, num_diff))
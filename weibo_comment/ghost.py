@@ -8,7 +8,9 @@ import time
 import glob
 import urllib
 import codecs
+import asyncio
 import logging
+import concurrent.futures
 from bs4 import BeautifulSoup
 
 import ghost_user_store
@@ -19,6 +21,8 @@ import ghost_msg_crawler
 
 import ghost_log
 import ghost_config
+import ghost_http_pool
+import ghost_rate_limiter
 import ghost_url_filter
 
 
@@ -43,11 +47,16 @@ class Ghost:
         self.user_store = ghost_user_store.UserStore(self.config, self.log)
         self.account_store = ghost_account_store.AccountStore(self.config, self.log)
 
+        self.http_pool = ghost_http_pool.ConnectionPool()#keep-alive connections shared by crawlers
+        self.http_pool.max_size = self.config.get_int('http_pool_size', 16)
+        self.http_pool.idle_time = self.config.get_int('http_idle_time', 60)
+        self.rate_limiter = ghost_rate_limiter.RateLimiter(self.config, self.log)#token buckets shared by crawlers
+
         self.msg_store = ghost_msg_store.MessageStore(self.config, self.log)
-        self.msg_crawler = ghost_msg_crawler.MessageCrawler(self.config, self.log)
+        self.msg_crawler = ghost_msg_crawler.MessageCrawler(self.config, self.log, self.http_pool, self.rate_limiter)
 
         # self.page_store = ghost_page_store.PageStore(self.config, self.log)
-        # self.page_crawler = ghost_page_crawler.PageCrawler(self.config, self.log)
+        # self.page_crawler = ghost_page_crawler.PageCrawler(self.config, self.log, self.http_pool, self.rate_limiter)
 
         self.cfg_store_flush_limit = self.config.get_int('store_flush_limit', 1000)#in ghost.ini "store_flush_limit"="500"
         self.cfg_re_login_fail_count = self.config.get_int('re_login_fail_count', 10)
@@ -178,6 +187,8 @@ class Ghost:
         self.login_fail_count = 0
         while True:
             if not self.msg_crawler.hot_topic_ids_list:
+                self.log.write(self.msg_crawler.dump_page_stats())#requests issued/saved in last cycle
+                self.msg_crawler.reset_page_stats()
                 self._write_comment_id()#write comment_id data into file:msg_comment_ids
                 self.read_url_get_ids()#read urls get new ids,write them into file:hot_topic_ids
                 self.msg_crawler._load_hot_topic_file()#load file hot_topic_ids into list: hot_topic_ids_list
@@ -198,18 +209,14 @@ class Ghost:
             next_account_index = (next_account_index + 1) % num_accounts
 
             # msg_id = "3691582068560320"
-            self.msg_crawler.clear_comment_id_text_list()
-            com_tuple = self.msg_crawler.req_timeline(user.name, user.token, account, msg_id)#rsp_obj['data']
+            pager = self.msg_crawler.req_timeline(user.name, user.token, account, msg_id)
+            for comment_id, comment_text in pager:
+                self.comment_text_cache.append(comment_text)
 
-            if com_tuple is not None:
+            if pager.error is None:
                 self.msg_id_flag = 1
-                # print(com_tuple)
-                (comment_id_list,comment_text_list) = com_tuple
-                if not comment_id_list:
-                    continue
-                self.crawl_comment_id_dic[msg_id] = comment_id_list[0]
-                self._handle_comment_data(comment_text_list)
-                # print(len(comment_id_list))
+                if pager.newest_comment_id is not None:
+                    self.crawl_comment_id_dic[msg_id] = pager.newest_comment_id
             else:
                 self.msg_id_flag = 0
                 self.login_fail_count += 1
@@ -224,6 +231,73 @@ class Ghost:
             if len(self.comment_text_cache) >= self.cfg_store_flush_limit:#500
                 self._handle_comment_data(self.comment_text_cache)
                 self.comment_text_cache[:] = []
+    def start_async_crawl(self):
+        '''start_crawl的异步版本, 每个用户一个协程, 请求间隔按用户token单独计算'''
+        users = list(self.user_store.users.values())
+        if not users:
+            print('Error: no user found')
+            return
+        accounts = sorted(self.account_store.accounts)
+        if not accounts:
+            print('Error: no account found')
+            return
+        asyncio.run(self._async_crawl(users, accounts))
+
+    async def _async_crawl(self, users, accounts):
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=len(users)))
+        self.next_account_index = 0
+        self.login_fail_count = 0
+        self.login_lock = asyncio.Lock()
+        while True:
+            if not self.msg_crawler.hot_topic_ids_list:
+                self.log.write(self.msg_crawler.dump_page_stats())#requests issued/saved in last cycle
+                self.msg_crawler.reset_page_stats()
+                self._write_comment_id()
+                self.read_url_get_ids()
+                self.msg_crawler._load_hot_topic_file()
+                self.msg_crawler._load_msg_comment_ids()
+                self.msg_crawler._reload_msg_comment_id()
+                self.clear_crawl_comment_id_dict()
+                if not self.msg_crawler.hot_topic_ids_list:
+                    print('Error: no hot topic id found')
+                    return
+            # 每轮把当前所有msg_id放入队列, 由全部用户并发消费, 队列清空后再重新加载
+            queue = asyncio.Queue()
+            for msg_id in self.msg_crawler.hot_topic_ids_list:
+                queue.put_nowait(msg_id.strip())
+            self.msg_crawler.hot_topic_ids_list[:] = []
+            workers = [self._async_crawl_user(user, accounts, queue) for user in users]
+            await asyncio.gather(*workers)
+
+    async def _async_crawl_user(self, user, accounts, queue):
+        while not queue.empty():
+            msg_id = queue.get_nowait()
+            account = accounts[self.next_account_index]
+            self.next_account_index = (self.next_account_index + 1) % len(accounts)
+
+            pager = self.msg_crawler.req_timeline(user.name, user.token, account, msg_id)
+            async for comment_id, comment_text in pager:
+                self.comment_text_cache.append(comment_text)
+            if pager.error is None:
+                if pager.newest_comment_id is not None:
+                    self.crawl_comment_id_dic[msg_id] = pager.newest_comment_id
+            else:
+                queue.put_nowait(msg_id)  # 失败的msg_id交给其它用户重试
+                self.login_fail_count += 1
+
+            if self.login_fail_count > self.cfg_re_login_fail_count:
+                async with self.login_lock:
+                    if self.login_fail_count > self.cfg_re_login_fail_count:
+                        loop = asyncio.get_running_loop()
+                        await loop.run_in_executor(None, self.login_all_users)
+                        logger.debug("login faild for %s times ,reload the token data"%str(self.cfg_re_login_fail_count))
+                        self.login_fail_count = 0
+
+            if len(self.comment_text_cache) >= self.cfg_store_flush_limit:
+                self._handle_comment_data(self.comment_text_cache)
+                self.comment_text_cache[:] = []
+
     def _handle_comment_data(self, comment_text_list):
         if len(comment_text_list) >= self.cfg_store_flush_limit:
             self._write_comment_id()
@@ -235,6 +309,7 @@ class Ghost:
                 # logger.debug("count of comment_text_list reach 3000, write into timestamp_comment.txt")
                 # print("write into file...")
                 wf.writelines(comment_text_list)
+            self.log.write(self.http_pool.dump())
         else:
             self.comment_text_cache.extend(comment_text_list)
     def gen_timestamp(self):
@@ -246,4 +321,5 @@ if __name__ == '__main__':
     g = Ghost()
     # g.login_all_users()
     g.start_crawl()
+    # g.start_async_crawl()
 
@@ -58,3 +58,11 @@ class Config:
             except ValueError:
                 pass
         return default
+
+    def get_float(self, key, default=0.0):
+        if key in self.entries:
+            try:
+                return float(self.entries[key])
+            except ValueError:
+                pass
+        return default
@@ -17,10 +17,16 @@ import codecs
 import struct
 import hashlib
 import logging
+import collections
+import concurrent.futures
 
 import socket
-import urllib.error
-import urllib.request
+import asyncio
+import http.client
+import urllib.parse
+
+import ghost_http_pool
+import ghost_rate_limiter
 
 __all__ = ['MessageCrawler']
 
@@ -32,12 +38,18 @@ CFG_REV_ID = '7165'
 
 API_URL_LOGIN = 'k/login'
 API_URL_COMMENTS = 'statuses/comments.json'
+
+CFG_REQUEST_HEADERS = {
+    'Content-Type': 'application/x-www-form-urlencoded',
+    }
+
 class MessageRequest:
 
-    def __init__(self, url):#url ==>  http://sina.komoxo.com/2/sina/k/login
+    def __init__(self, url, http_pool=None):#url ==>  http://sina.komoxo.com/2/sina/k/login
         self.url = url
         self.params = { }
         self.timeout = 10
+        self.http_pool = http_pool or ghost_http_pool.default_pool
         self._reset()
 
     def _reset(self):
@@ -81,15 +93,15 @@ class MessageRequest:
             #print (self.post_data)
             #b'id=3658085715922582&pkg_id=3&rev_id=7165&tick=1395230407&user_id=1000440717&
             # user_name=ma12693%40126.com&md5=3a83af953ef147ec170b6074cebad7e1'
-            self.http_rsp = urllib.request.urlopen(self.url, data=self.post_data, timeout=self.timeout)
-        except urllib.error.URLError as err:
-            self.http_err = err
-            self._parser_response(self.http_err)
-            self.error = 'ERR: connection failed'
-            return
+            self.http_rsp = self.http_pool.request('POST', self.url, body=self.post_data, \
+                headers=CFG_REQUEST_HEADERS, timeout=self.timeout)
         except socket.timeout:
             self.error = 'ERR: connection timed out'
             return
+        except (OSError, http.client.HTTPException) as err:
+            self.http_err = err
+            self.error = 'ERR: connection failed'
+            return
         except:
             exc_type, exc_value, exc_trace = sys.exc_info()
             str_type = self._format(exc_type)
@@ -102,6 +114,7 @@ class MessageRequest:
         self._parser_response(self.http_rsp)#解析response返回状态
 
         if self.http_code != 200:
+            self.http_pool.release(self.http_rsp)
             self.error = 'ERR: connection failed'
             return
 
@@ -118,6 +131,8 @@ class MessageRequest:
             str_value = self._format(exc_value)
             self.error = 'ERR: response read exception, type=%s, value=%s' % (str_type, str_value)
             return
+        finally:
+            self.http_pool.release(self.http_rsp)
 
         # decompress response data
         #data = gzip.decompress(rsp_raw).decode("utf_8")
@@ -202,19 +217,154 @@ class Message:
         self.comment_id = comment_id
         self.text = comment_text  # 消息文本内容
 
+class CommentPager:
+    '''逐页遍历一条微博的新评论, 按从新到旧的顺序逐条返回(comment_id, comment_text)
+
+    某一页不满或者出现不大于msg_comment_id_dic中记录的最大comment_id(高水位)的评论时
+    立即停止翻页, 未发出的预取请求被取消。新微博一开始就预取cfg_msg_prefetch_pages页;
+    已有高水位的微博先只请求一页, 每遇到一整页新评论预取页数翻倍, 这样大部分只有
+    少量新评论的旧微博只需要一次请求。
+    第一页请求失败时error不为空, 由调用者换用户重试。
+    '''
+
+    def __init__(self, crawler, name, token, account, msg_id):
+        self.crawler = crawler
+        self.name = name
+        self.token = token
+        self.account = account
+        self.msg_id = msg_id
+        self.max_comment_id = crawler._get_max_comment_id(msg_id)
+        self.error = None
+        self.newest_comment_id = None
+        self.num_requests = 0       # 已处理的请求数
+        self.num_discarded = 0      # 已发出但越过高水位而丢弃的预取请求数
+        self.num_saved = 0          # 与固定预取窗口相比少发出的请求数
+        self.requests = [ ]
+
+    def _build_request(self, page):
+        req = self.crawler._build_timeline_request(self.name, self.token, self.account, self.msg_id)
+        req.set_param('page', str(page))
+        self.requests.append(req)
+        return req
+
+    def _fetch(self, page):
+        req = self._build_request(page)
+        self.crawler._commit_request(req)
+        return req
+
+    async def _fetch_async(self, page):
+        req = self._build_request(page)
+        await self.crawler._commit_request_async(req)
+        return req
+
+    def _initial_window(self):
+        if self.max_comment_id > 0:
+            return 1
+        return self.crawler.cfg_msg_prefetch_pages
+
+    def _next_window(self, window):
+        return min(window * 2, self.crawler.cfg_msg_prefetch_pages)
+
+    def _parser_page(self, req, first):
+        '''返回(comments, done), comments为本页的新评论'''
+        self.num_requests += 1
+        if not req.error:
+            rsp = req.rsp_obj['data']
+            if not isinstance(rsp, list):
+                req.error = 'Error: comments request failed'
+        if req.error:
+            if first:
+                self.error = req.error
+            return ([], True)
+        comment_ids_arr = []
+        comment_text_arr = []
+        crossed = False
+        for obj in rsp:
+            if isinstance(obj, dict) and isinstance(obj.get('id'), int):
+                if obj['id'] <= self.max_comment_id:
+                    crossed = True
+            self.crawler._parser_message(comment_ids_arr, comment_text_arr, obj, self.msg_id)
+        if comment_ids_arr and (self.newest_comment_id is None):
+            self.newest_comment_id = comment_ids_arr[0]
+        done = crossed or (len(comment_ids_arr) < self.crawler.cfg_msg_count_size)
+        return (list(zip(comment_ids_arr, comment_text_arr)), done)
+
+    def _finish(self, num_issued):
+        # 固定窗口在处理完第num_requests页时已经发出了num_requests + prefetch - 1个请求
+        fixed = self.num_requests + self.crawler.cfg_msg_prefetch_pages - 1
+        self.num_saved = max(0, fixed - num_issued)
+        self.crawler._update_page_stats(self)
+
+    def __iter__(self):
+        executor = self.crawler.prefetch_executor
+        next_page = self.crawler.cfg_msg_page_size
+        window = self._initial_window()
+        first = True
+        pending = collections.deque()
+        try:
+            while True:
+                while len(pending) < window:
+                    pending.append(executor.submit(self._fetch, next_page))
+                    next_page += 1
+                req = pending.popleft().result()
+                comments, done = self._parser_page(req, first)
+                first = False
+                for comment in comments:
+                    yield comment
+                if done:
+                    break
+                window = self._next_window(window)
+        finally:
+            num_issued = self.num_requests
+            for future in pending:
+                if not future.cancel():
+                    self.num_discarded += 1
+                    num_issued += 1
+            self._finish(num_issued)
+
+    def __aiter__(self):
+        return self._iter_async()
+
+    async def _iter_async(self):
+        next_page = self.crawler.cfg_msg_page_size
+        window = self._initial_window()
+        first = True
+        pending = collections.deque()
+        try:
+            while True:
+                while len(pending) < window:
+                    pending.append(asyncio.ensure_future(self._fetch_async(next_page)))
+                    next_page += 1
+                req = await pending.popleft()
+                comments, done = self._parser_page(req, first)
+                first = False
+                for comment in comments:
+                    yield comment
+                if done:
+                    break
+                window = self._next_window(window)
+        finally:
+            for task in pending:
+                task.cancel()
+            # 仍在等待限流令牌时被取消的请求没有发出, send()开始后post_data才不为空
+            num_issued = len([r for r in self.requests if r.post_data is not None])
+            self.num_discarded = max(0, num_issued - self.num_requests)
+            self._finish(num_issued)
+
 PATH = os.path.dirname(__file__)
 class MessageCrawler:
-    def __init__(self, config, log):
-        self.comment_ids_list = []
-        self.comment_text_list = []
+    def __init__(self, config, log, http_pool=None, rate_limiter=None):
         self.msg_comment_id_dic = {}#key:msg_id, value:comment_id
         self.hot_topic_ids_list = []#msg_id
         self.config = config
         self.log = log
+        self.http_pool = http_pool or ghost_http_pool.default_pool
         self._load_settings()
         self._load_hot_topic_file()#load hot_topic_ids_list
         self._load_msg_comment_ids()#load msg_comment_ids
-        self.last_req_time = 0  # the time when last request ended
+        self.rate_limiter = rate_limiter or ghost_rate_limiter.RateLimiter(config, log)
+        self.prefetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.cfg_msg_prefetch_pages)
+        self.reset_page_stats()
 
     def _load_hot_topic_file(self):
         filename = os.path.join(PATH, "sys", "hot_topic_ids")
@@ -264,6 +414,8 @@ class MessageCrawler:
         self.cfg_msg_page_size = self.config.get_int(key, 1)
         key = 'msg_count_size'
         self.cfg_msg_count_size = self.config.get_int(key, 20)
+        key = 'msg_prefetch_pages'
+        self.cfg_msg_prefetch_pages = max(1, self.config.get_int(key, 1))
         key = 'connection_timeout'
         self.cfg_connection_timeout = self.config.get_int(key, 10)
 
@@ -305,41 +457,12 @@ class MessageCrawler:
         req.set_param('id', msg_id)
         return req
 
-    def clear_comment_id_text_list(self):
-        self.comment_ids_list[:] = []
-        self.comment_text_list[:] = []
-
     def req_timeline(self, name, token, account, msg_id):#start crawl call this fuction
-        req = self._build_timeline_request(name, token, account, msg_id)
-        self._commit_request(req)
-        if req.error:
-            # self.logger.debug("msg_id:{msg_id},err_info:{err_info}".format(msg_id=msg_id,err_info=req.error))
-            return
-        rsp = req.rsp_obj['data']#rsp微博网页内容
-        weibo_id = req.params['id']
-        # print(rsp)
-        if isinstance(rsp, list):#此处rsp是dict元素的list
-            comment_ids_arr = []
-            comment_text_arr = []
-            for obj in rsp:
-                # print(obj)#obj为rsp中的dict元素
-                self._parser_message(comment_ids_arr, comment_text_arr, obj, weibo_id)
-            # print(msgs)
-            # print(len(comment_ids_arr))
-            self.comment_ids_list.extend(comment_ids_arr)
-            self.comment_text_list.extend(comment_text_arr)
-
-            # print(len(self.comment_ids_list))
-            if len(comment_ids_arr) is self.cfg_msg_count_size:#20
-                self.cfg_msg_page_size += 1
-                self.req_timeline(name, token, account, msg_id)
-            self.cfg_msg_page_size = 1
-            com_tuple = (self.comment_ids_list, self.comment_text_list)
-            # print(com_tuple)
-            return com_tuple
+        '''返回CommentPager, 用for或async for逐条取得新评论'''
+        return CommentPager(self, name, token, account, msg_id)
 
     def _create_request(self, api_url):
-        req = MessageRequest(CFG_BASE_URL + api_url)#CFG_BASE_URL = 'http://sina.komoxo.com/2/sina/';api_url = 'k/login'
+        req = MessageRequest(CFG_BASE_URL + api_url, self.http_pool)#CFG_BASE_URL = 'http://sina.komoxo.com/2/sina/';api_url = 'k/login'
         req.timeout = self.cfg_connection_timeout#connection timeout param
         req.set_param('pkg_id', CFG_PKG_ID)#CFG_PKG_ID = '3'
         req.set_param('rev_id', CFG_REV_ID)#CFG_REV_ID = '7165'
@@ -347,13 +470,52 @@ class MessageCrawler:
         req.set_param('tick', str(tick))
         return req
 
+    def _rate_keys(self, req):
+        keys = [('global', ''), ('endpoint', req.url)]
+        if 'user_name' in req.params:
+            keys.append(('user', req.params['user_name']))
+        for name in ('user_id', 'screen_name'):
+            if name in req.params:
+                keys.append(('account', req.params[name]))
+        return keys
+
     def _commit_request(self, req):
-        delay = time.time() - self.last_req_time # the time when last request ended
-        wait = self.cfg_msg_request_delay - delay #self.cfg_msg_request_delay相邻请求之间最少需要的时间间隔
-        if wait > 0.05:
+        keys = self._rate_keys(req)
+        wait = self.rate_limiter.acquire(keys)
+        while wait > 0:
             time.sleep(wait)
+            wait = self.rate_limiter.acquire(keys)
         req.send()
-        self.last_req_time = time.time()
+
+    async def _commit_request_async(self, req):
+        # 只有当前协程等待, 其它用户的请求照常进行
+        keys = self._rate_keys(req)
+        wait = self.rate_limiter.acquire(keys)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self.rate_limiter.acquire(keys)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, req.send)
+
+    def _get_max_comment_id(self, msg_id):
+        try:
+            return int(self.msg_comment_id_dic[msg_id])
+        except:
+            return 0
+
+    def reset_page_stats(self):
+        self.num_page_requests = 0
+        self.num_page_discarded = 0
+        self.num_page_saved = 0
+
+    def _update_page_stats(self, pager):
+        self.num_page_requests += pager.num_requests + pager.num_discarded
+        self.num_page_discarded += pager.num_discarded
+        self.num_page_saved += pager.num_saved
+
+    def dump_page_stats(self):
+        return 'COMMENT page requests=%d discarded=%d saved=%d' % \
+               (self.num_page_requests, self.num_page_discarded, self.num_page_saved)
 
     def _parser_message(self, comment_id_list, comment_text_list, obj, weiboId):
         if isinstance(obj, dict):
@@ -364,10 +526,7 @@ class MessageCrawler:
                 comment_id = obj['id']
                 comment_text = obj['text']+"\n"
                 # print(comment_text)
-                try:
-                    max_comment_id = int(self.msg_comment_id_dic[weiboId])
-                except:
-                    max_comment_id = 0
+                max_comment_id = self._get_max_comment_id(weiboId)
                 if comment_id > max_comment_id:
                     comment_text_list.append(comment_text)
                     comment_id_list.append(comment_id)
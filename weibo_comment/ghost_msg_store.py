@@ -5,13 +5,53 @@ import os
 import re
 import sys
 import time
+import array
 import codecs
+import itertools
+import collections
+
+import ghost_bloom_filter
+import ghost_rotating_file
 
 __all__ = ['MessageStore']
 
+class MessageIdCache:
+    """消息编号缓存, 超出容量时淘汰最早加入的编号, add/has/淘汰都是O(1)"""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def has(self, mid):
+        return mid in self.items
+
+    def add(self, mid):
+        if mid in self.items:
+            return False
+        self.items[mid] = None
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
+        return True
+
+    def load(self, ids):
+        """按加入顺序批量加载编号, 重复的编号以最后一次出现为准, 只保留最后size个"""
+        latest = collections.OrderedDict.fromkeys(reversed(ids))
+        newest = list(itertools.islice(latest, self.size))
+        newest.reverse()
+        self.items = collections.OrderedDict.fromkeys(newest)
+
 class MessageStore:
 
-    CACHE_FILE_NAME = 'msg_store_cache.txt'
+    # 追加写入的定长int64(小端)记录, 记录数超过2倍msg_cache_size时整体重写压缩
+    CACHE_FILE_NAME = 'msg_store_cache.bin'
+
+    LEGACY_CACHE_FILE_NAME = 'msg_store_cache.txt'
 
     CACHE_ITEM_PATTERN = re.compile(r'^(?P<mid>[0-9]+)', re.MULTILINE)
 
@@ -20,8 +60,11 @@ class MessageStore:
         self.log = log
         self._load_settings()
         self.chunks = [ ]
-        self.cache_list = [ ]
-        self.cache_set = set()
+        self.writer = self._create_writer()
+        self.cache = self._create_cache()
+        self.cache_log = array.array('q')  # ids added since last checkpoint
+        self.num_cache_records = 0
+        self.cache_compact_needed = False
        # self._load_cache()
 
     def _load_settings(self):
@@ -44,33 +87,73 @@ class MessageStore:
             print('Error: path not found %s' % path)
             sys.exit(1)
         self.cache_file_path = os.path.join(path, self.CACHE_FILE_NAME)#/mnt/data/ghost/src/sys/msg_store_cache.txt
+        self.legacy_cache_file_path = os.path.join(path, self.LEGACY_CACHE_FILE_NAME)
+        self.sys_path = path
 
         key = 'msg_cache_size'
         self.cache_size = self.config.get_int(key, 100)#1000000
 
+        # cache: 保留最近msg_cache_size个编号; bloom: 可扩展Bloom过滤器, 见ghost_bloom_filter
+        key = 'msg_dedup_mode'
+        self.cfg_dedup_mode = self.config.get(key, 'cache')
+        key = 'msg_bloom_capacity'
+        self.cfg_bloom_capacity = self.config.get_int(key, 100000000)
+        key = 'msg_bloom_error_rate'
+        self.cfg_bloom_error_rate = self.config.get_float(key, 0.001)
+
+        # batch: 消息缓存在内存中, flush时写入<timestamp>_msg.txt;
+        # stream: 消息直接写入轮转的缓冲输出文件, 内存占用与store_flush_limit无关
+        key = 'msg_store_mode'
+        self.cfg_store_mode = self.config.get(key, 'batch')
+        key = 'msg_rotate_size'
+        self.cfg_rotate_size = self.config.get_int(key, 64 * 1024 * 1024)
+        key = 'msg_rotate_count'
+        self.cfg_rotate_count = self.config.get_int(key, 0)
+        key = 'msg_rotate_time'
+        self.cfg_rotate_time = self.config.get_int(key, 60 * 60)
+
+    def _create_writer(self):
+        if self.cfg_store_mode != 'stream':
+            return None
+        writer = ghost_rotating_file.RotatingFile(self.store_path, '_msg.txt', self.log, 'msg store')
+        writer.max_bytes = self.cfg_rotate_size
+        writer.max_count = self.cfg_rotate_count
+        writer.max_time = self.cfg_rotate_time
+        return writer
+
+    def _create_cache(self):
+        if self.cfg_dedup_mode == 'bloom':
+            cache = ghost_bloom_filter.ScalableBloomFilter(self.sys_path, \
+                self.cfg_bloom_capacity, self.cfg_bloom_error_rate)
+            self.log.write('msg store bloom filter: %d items, %d bytes' % (len(cache), cache.memory_size()))
+            return cache
+        return MessageIdCache(self.cache_size)
+
     def has(self, msg):
-        if msg.mid in self.cache_set:
-            return True
-        else:
-            return False
+        return self.cache.has(msg.mid)
         
     def _format_message_text(self, text):
         return re.sub(r'[\r\n]+', '', text.strip())
         
     def add(self, msg):
-        if msg.mid in self.cache_set:
+        if not self.cache.add(msg.mid):
             return
-        self.cache_set.add(msg.mid)
-        self.cache_list.append(msg.mid)
-        if len(self.cache_set) > self.cache_size:
-            oldest = self.cache_list.pop(0)
-            self.cache_set.remove(oldest)
+        if self.cfg_dedup_mode != 'bloom':
+            self.cache_log.append(msg.mid)
         text = self._format_message_text(msg.text)
         if text:
             line = text + '\n'
-            self.chunks.append(line.encode('utf_8', errors='ignore'))
+            data = line.encode('utf_8', errors='ignore')
+            if self.writer:
+                self.writer.write(data)
+            else:
+                self.chunks.append(data)
 
     def flush(self, name):
+        if self.writer:
+            self.writer.flush()
+            self._save_cache()
+            return
         path = os.path.join(self.store_path, name + '_msg.txt')
         self._flush_store(path) #F:/ghost/src/out + timestamp + _msg.txt
         self._save_cache()
@@ -87,32 +170,208 @@ class MessageStore:
 
     def _save_cache(self):
         path = self.cache_file_path     #msg_store_cache.txt
-        text = ''.join(['%d\n' % mid for mid in self.cache_list])
-        data = text.encode('utf_8', errors='ignore')
+        if self.cfg_dedup_mode == 'bloom':
+            self.cache.flush()   # bloom filter is memory mapped, just sync to disk
+            self.log.write('msg store bloom filter: %d items' % len(self.cache))
+            return
+        num_records = self.num_cache_records + len(self.cache_log)
+        if self.cache_compact_needed or (num_records > 2 * self.cache_size):
+            self._compact_cache(path)
+        else:
+            self._append_cache(path)
+
+    def _pack_ids(self, ids):
+        if sys.byteorder != 'little':
+            ids = array.array('q', ids)
+            ids.byteswap()
+        return ids.tobytes()
+
+    def _append_cache(self, path):
+        data = self._pack_ids(self.cache_log)
         try:
-            open(path, 'w+b').write(data)
+            open(path, 'ab').write(data)
         except (OSError, IOError):
             self.log.write('ERR: failed to save %s' % path)
-        else:
-            self.log.write('msg store cache: save file %s' % path)
+            return
+        self.log.write('msg store cache: append %d items to %s' % (len(self.cache_log), path))
+        self.num_cache_records += len(self.cache_log)
+        self.cache_log = array.array('q')
+
+    def _compact_cache(self, path):
+        ids = array.array('q', self.cache)
+        temp_path = path + '.tmp'
+        try:
+            open(temp_path, 'w+b').write(self._pack_ids(ids))
+            os.replace(temp_path, path)
+        except (OSError, IOError):
+            self.log.write('ERR: failed to save %s' % path)
+            return
+        self.log.write('msg store cache: save file %s' % path)
+        self.num_cache_records = len(ids)
+        self.cache_log = array.array('q')
+        self.cache_compact_needed = False
 
     def _load_cache(self):
-        path = self.cache_file_path     #msg_store_cache.txt
+        path = self.cache_file_path
+        if self.cfg_dedup_mode == 'bloom':
+            return
+        if not os.path.isfile(path):
+            self._load_legacy_cache()
+            return
+        try:
+            data = open(path, 'rb').read()
+        except (OSError, IOError):
+            self.log.write('ERR: failed to load %s' % path)
+            return
+        self.log.write('msg store cache: load file %s' % path)
+        ids = array.array('q')
+        ids.frombytes(data[:len(data) - len(data) % ids.itemsize])
+        if len(data) % ids.itemsize:
+            self.cache_compact_needed = True   # drop the torn last record on next flush
+        if sys.byteorder != 'little':
+            ids.byteswap()
+        self.num_cache_records = len(ids)
+        self.cache.load(ids)
+        self.log.write('msg store cache: %d items loaded' % len(self.cache))
+
+    def _load_legacy_cache(self):
+        path = self.legacy_cache_file_path
         if not os.path.isfile(path):
             return
         try:
             data = open(path, 'r+b').read()
         except (OSError, IOError):
             self.log.write('ERR: failed to load %s' % path)
-        else:
-            self.log.write('msg store cache: load file %s' % path)
+            return
+        self.log.write('msg store cache: load file %s' % path)
         text = data.decode('utf_8', errors='ignore')
         for match in self.CACHE_ITEM_PATTERN.finditer(text):
             mid = int(match.group('mid'))
-            if not (mid in self.cache_set):
-                self.cache_set.add(mid)
-                self.cache_list.append(mid)
-                if len(self.cache_set) >= self.cache_size:
-                    break
-        self.log.write('msg store cache: %d items loaded' % len(self.cache_set))
+            self.cache.add(mid)
+            if len(self.cache) >= self.cache_size:
+                break
+        self.log.write('msg store cache: %d items loaded' % len(self.cache))
+        self.cache_compact_needed = True   # convert to binary checkpoint on next flush
+
+if __name__ == '__main__':
+
+    # micro benchmark: add/has throughput of a full cache, compared with
+    # the former list + set implementation whose eviction is list.pop(0)
+
+    class ListIdCache:
+
+        def __init__(self, size):
+            self.size = size
+            self.cache_list = [ ]
+            self.cache_set = set()
+
+        def has(self, mid):
+            return mid in self.cache_set
+
+        def add(self, mid):
+            if mid in self.cache_set:
+                return False
+            self.cache_set.add(mid)
+            self.cache_list.append(mid)
+            if len(self.cache_set) > self.size:
+                oldest = self.cache_list.pop(0)
+                self.cache_set.remove(oldest)
+            return True
+
+    size = 1000000
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+    base_mid = 3700000000000000
+
+    for name, cls, count in (('ordered', MessageIdCache, size), ('list+set', ListIdCache, 20000)):
+        cache = cls(size)
+        for mid in range(base_mid, base_mid + size):
+            cache.add(mid)
+        start = time.perf_counter()
+        for mid in range(base_mid + size, base_mid + size + count):
+            cache.add(mid)
+        add_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for mid in range(base_mid + count, base_mid + count * 2):
+            cache.has(mid)
+        has_time = time.perf_counter() - start
+        print('%-8s size %d: add %.0f ops/s, has %.0f ops/s (%d ops)' % \
+              (name, size, count / add_time, count / has_time, count))
+
+    # bloom filter: throughput, memory per id and measured false positive rate
+
+    import tempfile
+    import tracemalloc
+
+    tracemalloc.start()
+    cache = MessageIdCache(size)
+    for mid in range(base_mid, base_mid + size):
+        cache.add(mid)
+    cache_memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    cache = None
+    print('ordered  size %d: %.1f bytes/id' % (size, cache_memory / size))
+
+    for error_rate in (0.01, 0.001):
+        cache = ghost_bloom_filter.ScalableBloomFilter(tempfile.mkdtemp(), size, error_rate)
+        start = time.perf_counter()
+        for mid in range(base_mid, base_mid + size):
+            cache.add(mid)
+        add_time = time.perf_counter() - start
+        count = min(size, 100000)
+        start = time.perf_counter()
+        false_positive = 0
+        for mid in range(base_mid + size, base_mid + size + count):
+            if cache.has(mid):
+                false_positive += 1
+        has_time = time.perf_counter() - start
+        print('bloom    size %d, error %g: add %.0f ops/s, has %.0f ops/s, %.2f bytes/id, false positive %.4f' % \
+              (size, error_rate, size / add_time, count / has_time, \
+              cache.memory_size() / size, false_positive / count))
+        cache.close()
+
+    # checkpoint: cost of a flush after 1000 new ids and of loading at
+    # startup, compared with rewriting and regex scanning the text file
+
+    import ghost_log
+    import ghost_config
+
+    temp_path = tempfile.mkdtemp()
+    config_path = os.path.join(temp_path, 'ghost.ini')
+    lines = [ ]
+    for key in ('sys_file_path', 'log_file_path', 'out_file_path'):
+        lines.append('"%s" = "%s"' % (key, temp_path))
+    lines.append('"msg_cache_size" = "%d"' % size)
+    open(config_path, 'w').write('\n'.join(lines))
+    config = ghost_config.Config(config_path)
+    log = ghost_log.Log(config)
+
+    Msg = collections.namedtuple('Msg', 'mid text')
+    store = MessageStore(config, log)
+    for mid in range(base_mid, base_mid + size):
+        store.add(Msg(mid, ''))
+    store._save_cache()
+    for mid in range(base_mid + size, base_mid + size + 1000):
+        store.add(Msg(mid, ''))
+    start = time.perf_counter()
+    store._save_cache()
+    append_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    text = ''.join(['%d\n' % mid for mid in store.cache])
+    open(store.legacy_cache_file_path, 'w+b').write(text.encode('utf_8'))
+    rewrite_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    store = MessageStore(config, log)
+    load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    legacy = MessageIdCache(size)
+    text = open(store.legacy_cache_file_path, 'rb').read().decode('utf_8')
+    for match in MessageStore.CACHE_ITEM_PATTERN.finditer(text):
+        legacy.add(int(match.group('mid')))
+    legacy_load_time = time.perf_counter() - start
 
+    print('checkpoint size %d: flush 1000 new ids %.4fs (text rewrite %.4fs), load %.3fs (text %.3fs)' % \
+          (size, append_time, rewrite_time, load_time, legacy_load_time))
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#-------------------------------------------------------------------------
+#
+# 令牌桶请求频率限制
+#
+#-------------------------------------------------------------------------
+
+import time
+import threading
+
+__all__ = ['RateLimiter']
+
+# 限流的键类型, 对应配置项 "rate_<kind>_per_minute", 0 表示不限制
+RATE_KINDS = ('global', 'endpoint', 'user', 'account', 'host')
+
+class TokenBucket:
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate            # 每秒补充的令牌数
+        self.burst = burst          # 令牌桶容量
+        self.tokens = burst
+        self.update_time = now
+
+    def _refill(self, now):
+        if now > self.update_time:
+            self.tokens = min(self.burst, self.tokens + (now - self.update_time) * self.rate)
+            self.update_time = now
+
+    def wait_time(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+class RateLimiter:
+
+    def __init__(self, config, log):
+        self.config = config
+        self.log = log
+        self.rates = { }        # key:kind, value:requests per minute
+        self.buckets = { }      # key:(kind, name), value:TokenBucket
+        self.lock = threading.Lock()
+        self._load_settings()
+
+    def _load_settings(self):
+        key = 'msg_request_delay'
+        delay = self.config.get_int(key, 3)
+        for kind in RATE_KINDS:
+            key = 'rate_%s_per_minute' % kind
+            if (kind == 'user') and (delay > 0):
+                # 默认沿用msg_request_delay, 按用户token计算
+                self.rates[kind] = self.config.get_int(key, 60.0 / delay)
+            else:
+                self.rates[kind] = self.config.get_int(key, 0)
+        key = 'rate_burst'
+        self.cfg_rate_burst = max(1, self.config.get_int(key, 1))
+
+    def _get_buckets(self, keys, now):
+        buckets = [ ]
+        for kind, name in keys:
+            rate = self.rates.get(kind, 0)
+            if rate <= 0:
+                continue
+            bucket = self.buckets.get((kind, name))
+            if bucket is None:
+                bucket = TokenBucket(rate / 60.0, self.cfg_rate_burst, now)
+                self.buckets[(kind, name)] = bucket
+            buckets.append(bucket)
+        return buckets
+
+    def wait_time(self, keys, now=None):
+        """返回keys全部就绪还需等待的秒数, 不消耗令牌"""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            buckets = self._get_buckets(keys, now)
+            return max([b.wait_time(now) for b in buckets] or [0])
+
+    def acquire(self, keys, now=None):
+        """keys全部就绪时消耗令牌并返回0, 否则不消耗令牌, 返回需等待的秒数"""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            buckets = self._get_buckets(keys, now)
+            wait = max([b.wait_time(now) for b in buckets] or [0])
+            if wait > 0:
+                return wait
+            for b in buckets:
+                b.consume(now)
+            return 0
+
+    def next_ready(self, candidates, now=None):
+        """从候选的keys列表中挑出最先就绪的一项, 返回(index, wait)
+
+        wait为0时该项的令牌已被消耗, 调用者可以立即发出请求;
+        否则没有就绪的候选项, 调用者可以去做其它事情或等待wait秒后重试。
+        candidates为空时返回(None, None)。
+        """
+        if now is None:
+            now = time.time()
+        best_index = None
+        best_wait = None
+        with self.lock:
+            for i, keys in enumerate(candidates):
+                buckets = self._get_buckets(keys, now)
+                wait = max([b.wait_time(now) for b in buckets] or [0])
+                if wait <= 0:
+                    for b in buckets:
+                        b.consume(now)
+                    return (i, 0)
+                if (best_wait == None) or (wait < best_wait):
+                    best_index = i
+                    best_wait = wait
+        return (best_index, best_wait)
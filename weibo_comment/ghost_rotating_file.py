@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#-------------------------------------------------------------------------
+#
+# 按大小/条数/时间轮转的缓冲输出文件
+#
+#-------------------------------------------------------------------------
+
+import os
+import time
+
+__all__ = ['RotatingFile']
+
+class RotatingFile:
+
+    def __init__(self, path, suffix, log, name):
+        self.path = path            # 输出目录
+        self.suffix = suffix        # 文件名为 <timestamp><suffix>
+        self.log = log
+        self.name = name            # 日志中的名称
+        self.max_bytes = 0          # 单个文件最大字节数, 0表示不限制
+        self.max_count = 0          # 单个文件最多写入次数, 0表示不限制
+        self.max_time = 0           # 单个文件最长写入时间(单位:秒), 0表示不限制
+        self.buffer_size = 65536
+        self.file = None
+        self.file_path = None
+
+    def _open(self):
+        name = time.strftime('%Y_%m_%d_%H%M%S')
+        self.file_path = os.path.join(self.path, name + self.suffix)
+        i = 1
+        while os.path.exists(self.file_path):
+            # rotated more than once within a second
+            self.file_path = os.path.join(self.path, '%s_%d%s' % (name, i, self.suffix))
+            i += 1
+        self.num_bytes = 0
+        self.num_count = 0
+        self.open_time = time.time()
+        try:
+            self.file = open(self.file_path, 'ab', buffering=self.buffer_size)
+        except (OSError, IOError):
+            self.log.write('ERR: failed to save %s' % self.file_path)
+            self.file = None
+
+    def _should_rotate(self):
+        if self.max_bytes and (self.num_bytes >= self.max_bytes):
+            return True
+        if self.max_count and (self.num_count >= self.max_count):
+            return True
+        if self.max_time and (time.time() - self.open_time >= self.max_time):
+            return True
+        return False
+
+    def write(self, data):
+        if self.file is None:
+            self._open()
+            if self.file is None:
+                return
+        try:
+            self.file.write(data)
+        except (OSError, IOError):
+            self.log.write('ERR: failed to save %s' % self.file_path)
+            self.close()
+            return
+        self.num_bytes += len(data)
+        self.num_count += 1
+        if self._should_rotate():
+            self.close()
+
+    def flush(self):
+        if self.file is None:
+            return
+        if self._should_rotate():
+            self.close()
+            return
+        try:
+            self.file.flush()
+        except (OSError, IOError):
+            self.log.write('ERR: failed to save %s' % self.file_path)
+
+    def close(self):
+        if self.file is None:
+            return
+        try:
+            self.file.close()
+        except (OSError, IOError):
+            self.log.write('ERR: failed to save %s' % self.file_path)
+        else:
+            self.log.write('%s: save file %s' % (self.name, self.file_path))
+        self.file = None
@@ -8,8 +8,9 @@
 #-------------------------------------------------------------------------
 
 import re
+import urllib.parse
 
-__all__ = ['is_html_url', 'filter_html_urls']
+__all__ = ['is_html_url', 'filter_html_urls', 'canonicalize_url']
 
 # 常见的非html内容的URL类型
 NON_HTML_EXTS = {
@@ -25,6 +26,17 @@ NON_HTML_EXTS = {
     '.css', '.js',  '.ttf', '.otf',
     }
 
+# 只用于统计来源、不影响网页内容的跟踪参数, 规范化URL时去掉
+# vt, display, from等参数在新浪网站上会选择不同版本的网页, 不能去掉
+TRACKING_PARAMS = {
+    'spm', 'sudaref', 'refer_flag',
+    'gclid', 'fbclid', 'mkt_tok', 'yclid',
+    }
+
+TRACKING_PARAM_PREFIXES = ('utm_',)
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
 EXT_PATTERN = re.compile(r'\A.+(?P<ext>\.[a-z0-9]+)\Z', re.IGNORECASE)
 
 URL_PATTERN = re.compile(r'https?\:\/\/[\_\.\-\?\=\/\&a-z0-9]+', re.IGNORECASE)
@@ -46,3 +58,32 @@ def is_html_url(url):
 
 def filter_html_urls(msg):
     return [u for u in filter_urls(msg.text) if is_html_url(u)]
+
+def canonicalize_url(url):
+    """规范化URL: 协议和域名转为小写, 去掉默认端口、片段和跟踪参数"""
+    try:
+        parts = urllib.parse.urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if not host:
+        return url
+    if ':' in host:
+        # IPv6 literal
+        host = '[%s]' % host
+    if port and (port != DEFAULT_PORTS.get(scheme)):
+        host = '%s:%d' % (host, port)
+    query = parts.query
+    if query:
+        params = [ ]
+        for param in query.split('&'):
+            if not param:
+                continue
+            name = param.split('=', 1)[0].lower()
+            if (name in TRACKING_PARAMS) or name.startswith(TRACKING_PARAM_PREFIXES):
+                continue
+            params.append(param)
+        query = '&'.join(params)
+    return urllib.parse.urlunsplit((scheme, host, parts.path or '/', query, ''))
@@ -6,6 +6,8 @@ import re
 import sys
 import time
 import codecs
+import asyncio
+import concurrent.futures
 
 import ghost_user_store
 import ghost_account_store
@@ -15,9 +17,13 @@ import ghost_msg_crawler
 
 import ghost_page_store
 import ghost_page_crawler
+import ghost_page_fetcher
 
 import ghost_log
 import ghost_config
+import ghost_http_pool
+import ghost_rate_limiter
+import ghost_link_cache
 import ghost_url_filter
 
 SCRIPT_PATH = os.path.dirname(__file__)
@@ -32,14 +38,33 @@ class Ghost:
         self.user_store = ghost_user_store.UserStore(self.config, self.log)
         self.account_store = ghost_account_store.AccountStore(self.config, self.log)
 
+        # keep-alive connections shared by the message and page crawlers
+        self.http_pool = ghost_http_pool.ConnectionPool()
+        self.http_pool.max_size = self.config.get_int('http_pool_size', 16)
+        self.http_pool.idle_time = self.config.get_int('http_idle_time', 60)
+        # one set of token buckets, so the global rate covers both crawlers
+        self.rate_limiter = ghost_rate_limiter.RateLimiter(self.config, self.log)
+
         self.msg_store = ghost_msg_store.MessageStore(self.config, self.log)
-        self.msg_crawler = ghost_msg_crawler.MessageCrawler(self.config, self.log)
+        self.msg_crawler = ghost_msg_crawler.MessageCrawler(self.config, self.log, self.http_pool, self.rate_limiter)
 
         self.page_store = ghost_page_store.PageStore(self.config, self.log)
-        self.page_crawler = ghost_page_crawler.PageCrawler(self.config, self.log)
+        self.page_crawler = ghost_page_crawler.PageCrawler(self.config, self.log, self.http_pool, self.rate_limiter)
+        self.link_cache = ghost_link_cache.LinkCache(self.config, self.log)
+        self.page_crawler.link_cache = self.link_cache
 
         self.cfg_store_flush_limit = self.config.get_int('store_flush_limit', 2000)
         self.cfg_page_expired_time = self.config.get_int('page_expired_time', 2 * 24 * 60 * 60)
+
+        # page fetches run in background threads, 0 to fetch inline
+        self.page_fetcher = None
+        num_workers = self.config.get_int('page_fetch_workers', 4)
+        if num_workers > 0:
+            self.page_fetcher = ghost_page_fetcher.PageFetcher(self.page_crawler, self.log)
+            self.page_fetcher.num_workers = num_workers
+            self.page_fetcher.max_queued = self.config.get_int('page_fetch_queue_size', 1000)
+            self.page_fetcher.host_limit = self.config.get_int('page_fetch_host_limit', 2)
+            self.page_fetcher.host_delay = self.config.get_float('page_fetch_host_delay', 0)
         
     def _load_config(self, path):
         if not path:
@@ -134,14 +159,31 @@ class Ghost:
         self.num_tapi_failed = 0
         self.num_page_commit = 0
         self.num_page_failed = 0
+        self.num_page_not_modified = 0
+        self.num_page_dropped = 0
+        if self.page_fetcher:
+            self.page_fetcher.start()
 
         while True:
-            user = users[next_user_index]
-            next_user_index = (next_user_index + 1) % num_users
-            account = accounts[next_account_index]
-            next_account_index = (next_account_index + 1) % num_accounts
+            # take the first (user, account) pair in round robin order whose
+            # tokens are ready, each user paired with a different account
+            candidates = [ ]
+            for i in range(num_users):
+                user = users[(next_user_index + i) % num_users]
+                account = accounts[(next_account_index + i) % num_accounts]
+                candidates.append(self.msg_crawler.timeline_rate_keys(user.name, account))
+            index, wait = self.rate_limiter.next_ready(candidates)
+            if wait > 0:
+                # none is ready, store the pages fetched meanwhile until one is
+                self._collect_pages()
+                time.sleep(wait)
+                continue
+            user = users[(next_user_index + index) % num_users]
+            next_user_index = (next_user_index + index + 1) % num_users
+            account = accounts[(next_account_index + index) % num_accounts]
+            next_account_index = (next_account_index + index + 1) % num_accounts
 
-            msgs = self.msg_crawler.req_timeline(user.name, user.token, account)
+            msgs = self.msg_crawler.req_timeline(user.name, user.token, account, True)
             self.num_tapi_commit += 1
             if msgs == None:
                 self.num_tapi_failed += 1
@@ -149,15 +191,73 @@ class Ghost:
                 self._handle_message_data(msgs)
                 
             if self.num_tapi_commit >= self.cfg_store_flush_limit:
-                self.log.write('TAPI commit=%d failed=%d' % (self.num_tapi_commit, self.num_tapi_failed))
-                self.log.write('PAGE commit=%d failed=%d' % (self.num_page_commit, self.num_page_failed))
-                name = time.strftime('%Y_%m_%d_%H%M%S')
-                self.msg_store.flush(name)
-                self.page_store.flush(name)
-                self.num_tapi_commit = 0
-                self.num_tapi_failed = 0
-                self.num_page_commit = 0
-                self.num_page_failed = 0
+                self._flush_stores()
+
+    def start_async_crawl(self):
+        users = list(self.user_store.users.values())
+        if not users:
+            print('Error: no user found')
+            return
+        accounts = sorted(self.account_store.accounts)
+        if not accounts:
+            print('Error: no account found')
+            return
+        asyncio.run(self._async_crawl(users, accounts))
+
+    async def _async_crawl(self, users, accounts):
+        loop = asyncio.get_running_loop()
+        # one thread per user for timeline requests, plus one for page handling
+        loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=len(users) + 1))
+        self.next_account_index = 0
+        self.num_tapi_commit = 0
+        self.num_tapi_failed = 0
+        self.num_page_commit = 0
+        self.num_page_failed = 0
+        self.num_page_not_modified = 0
+        self.num_page_dropped = 0
+        if self.page_fetcher:
+            self.page_fetcher.start()
+        # stores and page crawler are not thread safe, handle one batch at a time
+        self.handle_lock = asyncio.Lock()
+        workers = [self._async_crawl_user(user, accounts) for user in users]
+        await asyncio.gather(*workers)
+
+    async def _async_crawl_user(self, user, accounts):
+        loop = asyncio.get_running_loop()
+        while True:
+            account = accounts[self.next_account_index]
+            self.next_account_index = (self.next_account_index + 1) % len(accounts)
+
+            msgs = await self.msg_crawler.req_timeline_async(user.name, user.token, account)
+            async with self.handle_lock:
+                self.num_tapi_commit += 1
+                if msgs == None:
+                    self.num_tapi_failed += 1
+                else:
+                    await loop.run_in_executor(None, self._handle_message_data, msgs)
+                if self.num_tapi_commit >= self.cfg_store_flush_limit:
+                    self._flush_stores()
+
+    def _flush_stores(self):
+        self.log.write('TAPI commit=%d failed=%d' % (self.num_tapi_commit, self.num_tapi_failed))
+        self._collect_pages()
+        self.log.write('PAGE commit=%d failed=%d not_modified=%d dropped=%d' % \
+                       (self.num_page_commit, self.num_page_failed, self.num_page_not_modified, self.num_page_dropped))
+        if self.page_fetcher:
+            self.log.write(self.page_fetcher.dump())
+        self.log.write(self.page_crawler.dump_codec_stats())
+        self.log.write(self.link_cache.dump())
+        self.log.write(self.http_pool.dump())
+        name = time.strftime('%Y_%m_%d_%H%M%S')
+        self.msg_store.flush(name)
+        self.page_store.flush(name)
+        self.link_cache.save()
+        self.num_tapi_commit = 0
+        self.num_tapi_failed = 0
+        self.num_page_commit = 0
+        self.num_page_failed = 0
+        self.num_page_not_modified = 0
+        self.num_page_dropped = 0
 
     def _handle_message_data(self, msgs):
         urls = [ ]
@@ -166,18 +266,57 @@ class Ghost:
                 continue
             self.msg_store.add(msg)
             urls.extend(ghost_url_filter.filter_html_urls(msg))
+        self._collect_pages()
         timestamp = int(time.time())
         for url in urls:
             last_access_timestamp = self.page_store.get_timestamp(url)
             if timestamp - last_access_timestamp < self.cfg_page_expired_time:
                 continue
-            resolved_url, page_data = self.page_crawler.request(url)
-            self.num_page_commit += 1
-            if page_data == None:
-                self.num_page_failed += 1
-            if url != resolved_url:
-                self.page_store.update(url, None, timestamp)
-            self.page_store.update(resolved_url, page_data, timestamp)
+            target_url = url
+            resolved_url = None
+            if self.link_cache.is_short(url):
+                resolved_url = self.link_cache.get(url, timestamp)
+                if resolved_url and (timestamp - self.page_store.get_timestamp(resolved_url) < self.cfg_page_expired_time):
+                    # the target page is still fresh, no request needed
+                    self.page_store.update(url, None, timestamp)
+                    continue
+                target_url = resolved_url
+            # revalidate with the ETag/Last-Modified of the last fetch
+            validators = None
+            if target_url:
+                validators = self.page_store.get_validators(target_url)
+            if self.page_fetcher:
+                if not self.page_fetcher.submit(url, timestamp, validators, resolved_url):
+                    # fetch queue is full, the link is retried when it shows up again
+                    self.num_page_dropped += 1
+                continue
+            # the link cache was looked up above, fetch() does not look again
+            req = self.page_crawler.fetch(url, validators, resolved_url)
+            self._update_page(url, req, timestamp)
+
+    def _collect_pages(self):
+        if not self.page_fetcher:
+            return
+        for url, req, timestamp in self.page_fetcher.poll():
+            self._update_page(url, req, timestamp)
+
+    def _update_page(self, url, req, timestamp):
+        self.num_page_commit += 1
+        if req is None:
+            self.num_page_failed += 1
+            self.page_store.update(url, None, timestamp)
+            return
+        resolved_url = req.resolved_url
+        if req.not_modified:
+            self.num_page_not_modified += 1
+        elif req.recv_data == None:
+            self.num_page_failed += 1
+        validators = req.get_validators()
+        if url != resolved_url:
+            # the next fetch looks the validators up by the link before the
+            # redirects, the request headers are resent to every hop
+            self.page_store.update(url, None, timestamp, validators)
+        self.page_store.update(resolved_url, req.recv_data, timestamp, validators, req.charset)
 
 ##############################################################################
 
@@ -189,6 +328,7 @@ Remove user:         ghost user remove NAME
 Login users:         ghost user login
 Add accounts:        ghost account add FILE
 Start crawl service: ghost crawl start
+Start async crawl:   ghost crawl async
 
 options:
 
@@ -256,6 +396,9 @@ if __name__ == '__main__':
     elif (len(args) == 2) and (args[0] == 'crawl') and (args[1] == 'start'):
         ghost.start_crawl()
 
+    elif (len(args) == 2) and (args[0] == 'crawl') and (args[1] == 'async'):
+        ghost.start_async_crawl()
+
     else:
         print('Error: unknown argument')
         sys.exit(1)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#-------------------------------------------------------------------------
+#
+# HTTP长连接池
+#
+#-------------------------------------------------------------------------
+
+import time
+import atexit
+import threading
+
+import http.client
+import urllib.parse
+
+__all__ = ['ConnectionPool', 'default_pool']
+
+class ConnectionPool:
+
+    def __init__(self):
+        self.max_size = 16      # 最多保留的空闲连接数
+        self.idle_time = 60     # 空闲连接最长保留时间(单位:秒)
+        self.idle_conns = { }   # key:(scheme, host, port), value:[(conn, release_time)]
+        self.num_idle = 0
+        self.lock = threading.Lock()
+        self.num_connect = 0    # 新建连接次数
+        self.num_reuse = 0      # 复用连接次数
+        self.num_evict = 0      # 因空闲超时或超出容量而关闭的连接数
+
+    def request(self, method, url, body=None, headers=None, timeout=10):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme.lower(), parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        conn = self._acquire(key, timeout)
+        try:
+            rsp = self._send(conn, method, path, body, headers)
+        except (ConnectionError, http.client.BadStatusLine):
+            conn.close()
+            if not conn.pool_reused:
+                raise
+            # the server closed an idle connection, retry once on a new one
+            conn = self._connect(key, timeout)
+            try:
+                rsp = self._send(conn, method, path, body, headers)
+            except:
+                conn.close()
+                raise
+        except:
+            conn.close()
+            raise
+        rsp.url = url
+        rsp.pool_key = key
+        rsp.pool_conn = conn
+        return rsp
+
+    def release(self, rsp):
+        """归还响应所使用的连接, 未读完的响应直接关闭连接"""
+        conn = getattr(rsp, 'pool_conn', None)
+        if conn is None:
+            return
+        rsp.pool_conn = None
+        if not rsp.isclosed() or rsp.will_close:
+            rsp.close()
+            conn.close()
+            return
+        now = time.time()
+        with self.lock:
+            self._evict_idle(now)
+            if self.num_idle >= self.max_size:
+                self._evict_oldest()
+            self.idle_conns.setdefault(rsp.pool_key, []).append((conn, now))
+            self.num_idle += 1
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle_conns.values():
+                for conn, release_time in conns:
+                    conn.close()
+            self.idle_conns = { }
+            self.num_idle = 0
+
+    def dump(self):
+        return 'HTTP connect=%d reuse=%d evict=%d idle=%d' % \
+               (self.num_connect, self.num_reuse, self.num_evict, self.num_idle)
+
+    def _send(self, conn, method, path, body, headers):
+        conn.request(method, path, body=body, headers=headers or { })
+        return conn.getresponse()
+
+    def _acquire(self, key, timeout):
+        with self.lock:
+            self._evict_idle(time.time())
+            conns = self.idle_conns.get(key)
+            if conns:
+                conn, release_time = conns.pop()
+                self.num_idle -= 1
+                self.num_reuse += 1
+                conn.pool_reused = True
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn
+        return self._connect(key, timeout)
+
+    def _connect(self, key, timeout):
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        conn.pool_reused = False
+        with self.lock:
+            self.num_connect += 1
+        return conn
+
+    def _evict_idle(self, now):
+        # must be called with self.lock held
+        for key in list(self.idle_conns):
+            alive = [ ]
+            for conn, release_time in self.idle_conns[key]:
+                if now - release_time > self.idle_time:
+                    conn.close()
+                    self.num_idle -= 1
+                    self.num_evict += 1
+                else:
+                    alive.append((conn, release_time))
+            if alive:
+                self.idle_conns[key] = alive
+            else:
+                del self.idle_conns[key]
+
+    def _evict_oldest(self):
+        # must be called with self.lock held
+        oldest_key = None
+        oldest_time = None
+        for key, conns in self.idle_conns.items():
+            if (oldest_time == None) or (conns[0][1] < oldest_time):
+                oldest_key = key
+                oldest_time = conns[0][1]
+        if oldest_key == None:
+            return
+        conns = self.idle_conns[oldest_key]
+        conn, release_time = conns.pop(0)
+        if not conns:
+            del self.idle_conns[oldest_key]
+        conn.close()
+        self.num_idle -= 1
+        self.num_evict += 1
+
+# 调用者未指定连接池时共用的连接池, 空闲连接在下次使用时按超时关闭, 退出时全部关闭
+default_pool = ConnectionPool()
+atexit.register(default_pool.close)
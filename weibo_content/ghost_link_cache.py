@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#-------------------------------------------------------------------------
+#
+# 短链接解析结果缓存
+#
+# 记录t.cn等短链接跳转后的目标地址, 命中时直接请求目标地址, 不再经过
+# 短链接服务器跳转。缓存按最近更新时间淘汰, 超过有效期的记录视为未命中。
+#
+#-------------------------------------------------------------------------
+
+import os
+import re
+import sys
+import time
+import threading
+import collections
+
+__all__ = ['LinkCache']
+
+class LinkCache:
+
+    CACHE_FILE_NAME = 'link_cache.txt'
+
+    CACHE_ITEM_PATTERN = re.compile(r'^(?P<timestamp>[0-9]+)\s+(?P<url>\S+)\s+(?P<resolved_url>\S+)', re.MULTILINE)
+
+    def __init__(self, config, log):
+        self.config = config
+        self.log = log
+        self._load_settings()
+        self.cache_dict = collections.OrderedDict()   # key:url, value:(resolved_url, timestamp), 最早的在前
+        self.lock = threading.Lock()
+        self.num_hit = 0
+        self.num_miss = 0
+        self._load_cache()
+
+    def _load_settings(self):
+        key = 'sys_file_path'
+        path = self.config.get(key)
+        if not path:
+            print('Error: missing config option "%s"' % key)
+            sys.exit(1)
+        if not os.path.isdir(path):
+            print('Error: path not found %s' % path)
+            sys.exit(1)
+        self.cache_file_path = os.path.join(path, self.CACHE_FILE_NAME)
+
+        key = 'link_cache_size'
+        self.cache_size = self.config.get_int(key, 1000000)
+        key = 'link_cache_expired_time'
+        self.expired_time = self.config.get_int(key, 30 * 24 * 60 * 60)
+        key = 'short_link_hosts'
+        text = self.config.get(key) or 't.cn,sinaurl.cn'
+        self.short_hosts = set([h.strip().lower() for h in text.split(',') if h.strip()])
+
+    def is_short(self, url):
+        pos = url.find('://')
+        if pos < 0:
+            return False
+        host = url[pos + 3:].split('/', 1)[0].lower()
+        return host in self.short_hosts
+
+    def get(self, url, now=None):
+        """返回短链接的目标地址, 未命中或已过期时返回None"""
+        if now is None:
+            now = int(time.time())
+        with self.lock:
+            item = self.cache_dict.get(url)
+            if item is None:
+                self.num_miss += 1
+                return None
+            resolved_url, timestamp = item
+            if now - timestamp >= self.expired_time:
+                del self.cache_dict[url]
+                self.num_miss += 1
+                return None
+            self.num_hit += 1
+            return resolved_url
+
+    def update(self, url, resolved_url, timestamp=None):
+        if len(resolved_url.split()) != 1:
+            # empty or containing white spaces, can not be saved
+            return
+        if timestamp is None:
+            timestamp = int(time.time())
+        with self.lock:
+            self.cache_dict[url] = (resolved_url, timestamp)
+            self.cache_dict.move_to_end(url)
+            if len(self.cache_dict) > self.cache_size:
+                self.cache_dict.popitem(last=False)
+
+    def dump(self):
+        return 'LINK cache hit=%d miss=%d size=%d' % (self.num_hit, self.num_miss, len(self.cache_dict))
+
+    def save(self):
+        path = self.cache_file_path
+        chunks = [ ]
+        with self.lock:
+            for url, (resolved_url, timestamp) in self.cache_dict.items():
+                chunks.append('%d %s %s\n' % (timestamp, url, resolved_url))
+        text = ''.join(chunks)
+        data = text.encode('utf_8', errors='ignore')
+        try:
+            open(path, 'w+b').write(data)
+        except (OSError, IOError):
+            self.log.write('ERR: failed to save %s' % path)
+        else:
+            self.log.write('link cache: save file %s' % path)
+
+    def _load_cache(self):
+        path = self.cache_file_path
+        if not os.path.isfile(path):
+            return
+        try:
+            data = open(path, 'r+b').read()
+        except (OSError, IOError):
+            self.log.write('ERR: failed to load %s' % path)
+            return
+        self.log.write('link cache: load file %s' % path)
+        text = data.decode('utf_8', errors='ignore')
+        now = int(time.time())
+        for match in self.CACHE_ITEM_PATTERN.finditer(text):
+            timestamp = int(match.group('timestamp'))
+            if now - timestamp >= self.expired_time:
+                continue
+            # records are saved oldest first, later records win
+            url = match.group('url')
+            self.cache_dict[url] = (match.group('resolved_url'), timestamp)
+            self.cache_dict.move_to_end(url)
+            if len(self.cache_dict) > self.cache_size:
+                self.cache_dict.popitem(last=False)
+        self.log.write('link cache: %d items loaded' % len(self.cache_dict))
@@ -17,8 +17,12 @@ import struct
 import hashlib
 
 import socket
-import urllib.error
-import urllib.request
+import asyncio
+import http.client
+import urllib.parse
+
+import ghost_http_pool
+import ghost_rate_limiter
 
 __all__ = ['MessageCrawler']
 
@@ -31,12 +35,17 @@ CFG_REV_ID = '7165'
 API_URL_LOGIN = 'k/login'
 API_URL_TIMELINE = 'statuses/user_timeline.json'
 
+CFG_REQUEST_HEADERS = {
+    'Content-Type': 'application/x-www-form-urlencoded',
+    }
+
 class MessageRequest:
 
-    def __init__(self, url):
+    def __init__(self, url, http_pool=None):
         self.url = url
         self.params = { }
         self.timeout = 10
+        self.http_pool = http_pool or ghost_http_pool.default_pool
         self._reset()
 
     def _reset(self):
@@ -78,15 +87,15 @@ class MessageRequest:
         # make connection
 
         try:
-            self.http_rsp = urllib.request.urlopen(self.url, data=self.post_data, timeout=self.timeout)
-        except urllib.error.URLError as err:
-            self.http_err = err
-            self._parser_response(self.http_err)
-            self.error = 'ERR: connection failed'
-            return
+            self.http_rsp = self.http_pool.request('POST', self.url, body=self.post_data, \
+                headers=CFG_REQUEST_HEADERS, timeout=self.timeout)
         except socket.timeout:
             self.error = 'ERR: connection timed out'
             return
+        except (OSError, http.client.HTTPException) as err:
+            self.http_err = err
+            self.error = 'ERR: connection failed'
+            return
         except:
             exc_type, exc_value, exc_trace = sys.exc_info()
             str_type = self._format(exc_type)
@@ -99,6 +108,7 @@ class MessageRequest:
         self._parser_response(self.http_rsp)
 
         if self.http_code != 200:
+            self.http_pool.release(self.http_rsp)
             self.error = 'ERR: connection failed'
             return
 
@@ -115,6 +125,8 @@ class MessageRequest:
             str_value = self._format(exc_value)
             self.error = 'ERR: response read exception, type=%s, value=%s' % (str_type, str_value)
             return
+        finally:
+            self.http_pool.release(self.http_rsp)
 
         # decompress response data
 
@@ -196,11 +208,12 @@ class Message:
 
 class MessageCrawler:
 
-    def __init__(self, config, log):
+    def __init__(self, config, log, http_pool=None, rate_limiter=None):
         self.config = config
         self.log = log
+        self.http_pool = http_pool or ghost_http_pool.default_pool
         self._load_settings()
-        self.last_req_time = 0  # the time when last request ended
+        self.rate_limiter = rate_limiter or ghost_rate_limiter.RateLimiter(config, log)
 
     def _load_settings(self):
         key = 'msg_request_delay'
@@ -241,9 +254,29 @@ class MessageCrawler:
         req.set_param('page', str(self.cfg_msg_page_size))
         return req
     
-    def req_timeline(self, name, token, account):
+    def timeline_rate_keys(self, name, account):
+        """req_timeline()要消耗令牌的keys, 供调用者用RateLimiter.next_ready()挑选"""
+        return self._rate_keys(self._build_timeline_request(name, '', account))
+
+    def req_timeline(self, name, token, account, acquired=False):
+        """acquired为True时调用者已经通过RateLimiter.next_ready()消耗了令牌"""
         req = self._build_timeline_request(name, token, account)
-        self._commit_request(req)
+        self._commit_request(req, acquired)
+        if req.error:
+            self.log.write(req.dump())
+            return
+        rsp = req.rsp_obj['data']
+        if isinstance(rsp, list):
+            msgs = [ ]
+            for obj in rsp:
+                self._parser_message(msgs, obj)
+            return msgs
+        req.error = 'Error: timeline request failed'
+        self.log.write(req.dump())
+
+    async def req_timeline_async(self, name, token, account):
+        req = self._build_timeline_request(name, token, account)
+        await self._commit_request_async(req)
         if req.error:
             self.log.write(req.dump())
             return
@@ -257,7 +290,7 @@ class MessageCrawler:
         self.log.write(req.dump())
 
     def _create_request(self, api_url):
-        req = MessageRequest(CFG_BASE_URL + api_url)
+        req = MessageRequest(CFG_BASE_URL + api_url, self.http_pool)
         req.timeout = self.cfg_connection_timeout
         req.set_param('pkg_id', CFG_PKG_ID)
         req.set_param('rev_id', CFG_REV_ID)
@@ -265,13 +298,33 @@ class MessageCrawler:
         req.set_param('tick', str(tick))
         return req
 
-    def _commit_request(self, req):
-        delay = time.time() - self.last_req_time
-        wait = self.cfg_msg_request_delay - delay
-        if wait > 0.05:
-            time.sleep(wait)
+    def _rate_keys(self, req):
+        keys = [('global', ''), ('endpoint', req.url)]
+        if 'user_name' in req.params:
+            keys.append(('user', req.params['user_name']))
+        for name in ('user_id', 'screen_name'):
+            if name in req.params:
+                keys.append(('account', req.params[name]))
+        return keys
+
+    def _commit_request(self, req, acquired=False):
+        if not acquired:
+            keys = self._rate_keys(req)
+            wait = self.rate_limiter.acquire(keys)
+            while wait > 0:
+                time.sleep(wait)
+                wait = self.rate_limiter.acquire(keys)
         req.send()
-        self.last_req_time = time.time()
+
+    async def _commit_request_async(self, req):
+        # only this coroutine waits, requests of other users go on
+        keys = self._rate_keys(req)
+        wait = self.rate_limiter.acquire(keys)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = self.rate_limiter.acquire(keys)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, req.send)
 
     def _parser_message(self, msgs, obj):
         if isinstance(obj, dict):
@@ -3,17 +3,29 @@
 
 import re
 import sys
+import time
+import threading
 
 import zlib
-import gzip
-import struct
 
 import socket
-import urllib.error
-import urllib.request
+import http.client
+import urllib.parse
 
+import ghost_http_pool
+import ghost_rate_limiter
 import ghost_url_filter
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# brotli before 1.2 can not cap the decompressed size (output_buffer_limit),
+# a small br response could expand without bound, do not accept br then
+if brotli and not hasattr(brotli.Decompressor, 'can_accept_more_data'):
+    brotli = None
+
 __all__ = ['PageCrawler']
 
 CFG_REQUEST_HEADERS = {
@@ -22,12 +34,44 @@ CFG_REQUEST_HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; WOW64)',
     }
 
+DECOMPRESS_ERRORS = (zlib.error,)
+if brotli:
+    DECOMPRESS_ERRORS += (brotli.error,)
+
+CFG_MAX_REDIRECTS = 10
+
+CFG_READ_CHUNK_SIZE = 65536
+
+# 不支持HEAD请求时返回的状态码, 改用GET请求并且不读取返回内容
+HEAD_UNSUPPORTED_CODES = {400, 403, 405, 501}
+
+REDIRECT_CODES = {301, 302, 303, 307, 308}
+
+class BrotliDecompressor:
+    """接口与zlib.decompressobj一致的brotli解压器, 输出达到max_length时停止解压"""
+
+    def __init__(self):
+        self.decompressor = brotli.Decompressor()
+
+    def decompress(self, data, max_length=0):
+        if max_length <= 0:
+            return self.decompressor.process(data)
+        # the output stops growing at max_length, the caller gives up on the
+        # response then, so the rest of the input is never needed
+        return self.decompressor.process(data, output_buffer_limit=max_length)
+
+    def flush(self):
+        return b''
+
 class HttpRequest:
 
-    def __init__(self, url):
+    def __init__(self, url, http_pool=None):
         self.initial_url = url
         self.timeout = 10
-        self.content_length_limit = 0
+        self.content_length_limit = 0       # 返回内容的最大字节数, 0表示不限制
+        self.decoded_length_limit = 0       # 解压后内容的最大字节数, 0表示不限制
+        self.validators = None      # 上次抓取时的(ETag, Last-Modified), 用于条件请求
+        self.http_pool = http_pool or ghost_http_pool.default_pool
         self._reset()
 
     def _reset(self):
@@ -35,29 +79,31 @@ class HttpRequest:
         self.resolved_url = self.initial_url
         self.http_code = 0
         self.http_reason = 'N/A'
-        self.http_req = None
         self.http_err = None
         self.http_rsp = None
-        self.http_raw = None
+        self.raw_size = 0
+        self.data_size = 0
+        self.codec = None
+        self.charset = None             # Content-Type中的字符集
         self.recv_data = None
+        self.not_modified = False
+        self.etag = None
+        self.last_modified = None
         
     def commit(self):
         self._reset()
     
         # make connection
         
-        self.http_req = urllib.request.Request(self.initial_url, headers=CFG_REQUEST_HEADERS)
-
         try:
-            self.http_rsp = urllib.request.urlopen(self.http_req, timeout=self.timeout)
-        except urllib.error.URLError as err:
-            self.http_err = err
-            self._parser_response(self.http_err)
-            self.error = 'ERR: connection failed'
-            return
+            self.http_rsp = self._open(self.initial_url)
         except socket.timeout:
             self.error = 'ERR: connection timed out'
             return
+        except (OSError, http.client.HTTPException, ValueError) as err:
+            self.http_err = err
+            self.error = 'ERR: connection failed'
+            return
         except:
             exc_type, exc_value, exc_trace = sys.exc_info()
             str_type = self._format(exc_type)
@@ -68,14 +114,22 @@ class HttpRequest:
         # check response
 
         self._parser_response(self.http_rsp)
+
+        if (self.http_code == 304) and self.validators:
+            # page not changed since the last fetch, nothing to download
+            self.http_rsp.read()
+            self.http_pool.release(self.http_rsp)
+            self.not_modified = True
+            return
         
         if self.http_code != 200:
+            self.http_pool.release(self.http_rsp)
             self.error = 'ERR: connection failed'
             return
 
         if self.resolved_url != self.initial_url:
             if not ghost_url_filter.is_html_url(self.resolved_url):
-                self.http_rsp.close()
+                self.http_pool.release(self.http_rsp)
                 self.error = 'ERR: non html url'
                 return
 
@@ -87,14 +141,14 @@ class HttpRequest:
                 except ValueError:
                     clen = 0
                 if clen > self.content_length_limit:
-                    self.http_rsp.close()
+                    self.http_pool.release(self.http_rsp)
                     self.error = 'ERR: content length exceed limit'
                     return
 
-        # read response data
+        # read and decompress response data, chunk by chunk
         
         try:
-            self.http_raw = self.http_rsp.read()
+            data = self._read_response(self.http_rsp)
         except socket.timeout:
             self.error = 'ERR: connection timed out'
             return
@@ -104,19 +158,78 @@ class HttpRequest:
             str_value = self._format(exc_value)
             self.error = 'ERR: response read exception, type=%s, value=%s' % (str_type, str_value)
             return
+        finally:
+            # a response aborted half way is closed instead of going back to the pool
+            self.http_pool.release(self.http_rsp)
 
-        # decompress response data
-
-        data = self.http_raw
-        if self.http_rsp.getheader('Content-Encoding') and len(data) > 0:
-            data = self._decompress_response(data)
-            if not data:
-                self.error = 'ERR: failed to decompress response data'
-                return
+        if data == None:
+            return
 
         if len(data) > 0:
             self.recv_data = data
-        
+            self.etag = self.http_rsp.getheader('ETag')
+            self.last_modified = self.http_rsp.getheader('Last-Modified')
+            self.charset = self.http_rsp.headers.get_content_charset()
+
+    def resolve(self):
+        """只跟随跳转得到最终地址, 不下载网页内容"""
+        self._reset()
+        rsp = None
+        try:
+            rsp = self._open(self.initial_url, 'HEAD')
+            # no body, but the response must be read to return the connection to the pool
+            rsp.read()
+            if rsp.status in HEAD_UNSUPPORTED_CODES:
+                self.http_pool.release(rsp)
+                # the body is left unread, release() closes the connection
+                rsp = self._open(self.initial_url, 'GET')
+        except socket.timeout:
+            self.error = 'ERR: connection timed out'
+            return
+        except (OSError, http.client.HTTPException, ValueError) as err:
+            self.http_err = err
+            self.error = 'ERR: connection failed'
+            return
+        except:
+            exc_type, exc_value, exc_trace = sys.exc_info()
+            str_type = self._format(exc_type)
+            str_value = self._format(exc_value)
+            self.error = 'ERR: url open exception, type=%s, value=%s' % (str_type, str_value)
+            return
+        finally:
+            if rsp is not None:
+                self.http_pool.release(rsp)
+        self.http_rsp = rsp
+        self._parser_response(rsp)
+        if self.http_code != 200:
+            self.error = 'ERR: connection failed'
+
+    def _request_headers(self, method):
+        headers = dict(CFG_REQUEST_HEADERS)
+        if brotli:
+            headers['Accept-Encoding'] += ',br'
+        if (method != 'GET') or not self.validators:
+            return headers
+        etag, last_modified = self.validators
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def _open(self, url, method='GET'):
+        # follow redirects, the connection of each hop goes back to the pool
+        headers = self._request_headers(method)
+        for i in range(CFG_MAX_REDIRECTS + 1):
+            rsp = self.http_pool.request(method, url, headers=headers, timeout=self.timeout)
+            location = rsp.getheader('Location')
+            if not ((rsp.status in REDIRECT_CODES) and location):
+                return rsp
+            rsp.read()
+            self.http_pool.release(rsp)
+            url = urllib.parse.urljoin(url, location)
+        return rsp
+
     def _format(self, obj):
         return re.sub(r'[\r\n]+', '', str(obj).strip())
         
@@ -128,15 +241,78 @@ class HttpRequest:
         if hasattr(rsp, 'reason'):
             self.http_reason = self._format(rsp.reason)
 
-    def _decompress_response(self, data):
-        try:
-            return gzip.decompress(data)
-        except (IOError, struct.error):
-            pass
-        try:
-            return zlib.decompressobj(-zlib.MAX_WBITS).decompress(data)
-        except zlib.error:
-            pass
+    def _read_response(self, rsp):
+        """读取并按Content-Encoding解压返回内容, 超出大小限制或解压失败时设置error并返回None"""
+        encoding = (rsp.getheader('Content-Encoding') or 'identity').strip().lower()
+        decompressor = None
+        chunks = [ ]
+        data_size = 0
+        while True:
+            chunk = rsp.read(CFG_READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            self.raw_size += len(chunk)
+            if self.content_length_limit and (self.raw_size > self.content_length_limit):
+                self.error = 'ERR: content length exceed limit, truncated at %d bytes' % self.raw_size
+                return None
+            if self.codec == None:
+                self.codec, decompressor = self._create_decompressor(encoding, chunk)
+                if self.codec == None:
+                    self.error = 'ERR: unsupported content encoding %s' % self._format(encoding)
+                    return None
+            if decompressor != None:
+                try:
+                    chunk = self._decompress(decompressor, chunk, data_size)
+                except DECOMPRESS_ERRORS:
+                    self.error = 'ERR: failed to decompress %s response data' % self.codec
+                    return None
+                if chunk == None:
+                    return None
+            chunks.append(chunk)
+            data_size += len(chunk)
+        if decompressor != None:
+            try:
+                chunk = decompressor.flush()
+            except DECOMPRESS_ERRORS:
+                chunk = None
+            if (chunk == None) or (data_size + len(chunk) == 0):
+                self.error = 'ERR: failed to decompress %s response data' % self.codec
+                return None
+            # flush() takes no max_length, check the tail of the stream as well
+            if self.decoded_length_limit and (data_size + len(chunk) > self.decoded_length_limit):
+                self.error = 'ERR: decoded length exceed limit, truncated at %d bytes' % self.decoded_length_limit
+                return None
+            chunks.append(chunk)
+            data_size += len(chunk)
+        self.data_size = data_size
+        return b''.join(chunks)
+
+    def _create_decompressor(self, encoding, data):
+        """按Content-Encoding创建解压器, 返回(codec, decompressor), 不支持的编码返回(None, None)"""
+        if encoding == 'identity':
+            return ('identity', None)
+        if encoding in ('gzip', 'x-gzip'):
+            return ('gzip', zlib.decompressobj(16 + zlib.MAX_WBITS))
+        if encoding == 'deflate':
+            # should be zlib wrapped, but some servers send raw deflate data,
+            # tell them apart by the zlib header (CM = 8, FCHECK)
+            if (len(data) >= 2) and ((data[0] & 0x0f) == 8) and (((data[0] << 8) | data[1]) % 31 == 0):
+                return ('deflate', zlib.decompressobj(zlib.MAX_WBITS))
+            return ('raw_deflate', zlib.decompressobj(-zlib.MAX_WBITS))
+        if (encoding == 'br') and brotli:
+            return ('br', BrotliDecompressor())
+        return (None, None)
+
+    def _decompress(self, decompressor, data, data_size):
+        # decompress at most one byte over the limit to detect compression bombs
+        max_length = 0
+        if self.decoded_length_limit:
+            max_length = self.decoded_length_limit - data_size + 1
+        data = decompressor.decompress(data, max_length)
+        if self.decoded_length_limit and (data_size + len(data) > self.decoded_length_limit):
+            self.error = 'ERR: decoded length exceed limit, truncated at %d bytes' % self.decoded_length_limit
+            return None
+        return data
 
     def dump(self):
         lines = [ ]
@@ -147,12 +323,22 @@ class HttpRequest:
             lines.append('  RESOLVED=%s' % self.resolved_url)
         lines.append('  HTTP_STATUS=%d, %s' % (self.http_code, self.http_reason))
         return lines
+
+    def get_validators(self):
+        if self.etag or self.last_modified:
+            return (self.etag, self.last_modified)
+        return None
         
 class PageCrawler:
 
-    def __init__(self, config, log):
+    def __init__(self, config, log, http_pool=None, rate_limiter=None):
         self.config = config
         self.log = log
+        self.http_pool = http_pool or ghost_http_pool.default_pool
+        self.rate_limiter = rate_limiter or ghost_rate_limiter.RateLimiter(config, log)
+        self.codec_stats = { }      # key:codec, value:[pages, raw bytes, decoded bytes]
+        self.stats_lock = threading.Lock()
+        self.link_cache = None      # 短链接解析结果缓存, 为None时不使用
         self._load_settings()
         
     def _load_settings(self):
@@ -160,19 +346,92 @@ class PageCrawler:
         self.cfg_connection_timeout = self.config.get_int(key, 10)
         key = 'content_length_limit'
         self.cfg_content_length_limit = self.config.get_int(key, 1024 * 1024 * 2)
+        key = 'decoded_length_limit'
+        self.cfg_decoded_length_limit = self.config.get_int(key, 1024 * 1024 * 8)
+        key = 'link_resolve_mode'
+        self.cfg_link_resolve_mode = self.config.get(key) or 'get'
 
     def _build_request(self, url):
-        req = HttpRequest(url)
+        req = HttpRequest(url, self.http_pool)
         req.timeout = self.cfg_connection_timeout
         req.content_length_limit = self.cfg_content_length_limit
+        req.decoded_length_limit = self.cfg_decoded_length_limit
         return req
 
-    def _commit_request(self, req):
+    def rate_keys(self, url):
+        """请求url时要消耗令牌的keys"""
+        host = urllib.parse.urlsplit(url).hostname or ''
+        return [('host', host.lower())]
+
+    def _acquire(self, req):
+        keys = self.rate_keys(req.initial_url)
+        wait = self.rate_limiter.acquire(keys)
+        while wait > 0:
+            time.sleep(wait)
+            wait = self.rate_limiter.acquire(keys)
+
+    def _commit_request(self, req, acquired=False):
+        if not acquired:
+            self._acquire(req)
         req.commit()
         
-    def request(self, url):
+    def dump_codec_stats(self):
+        with self.stats_lock:
+            items = ['%s=%d/%d/%d' % (codec, pages, raw_size, data_size) \
+                     for codec, (pages, raw_size, data_size) in sorted(self.codec_stats.items())]
+            self.codec_stats = { }
+        return 'PAGE codec pages/raw/decoded %s' % ' '.join(items)
+
+    def resolve(self, url, acquired=False):
+        """请求短链接得到跳转后的最终地址并更新link_cache, 失败时返回None"""
         req = self._build_request(url)
-        self._commit_request(req)
+        if not acquired:
+            self._acquire(req)
+        req.resolve()
         if req.error:
             self.log.write(req.dump())
+            return None
+        if self.link_cache:
+            self.link_cache.update(url, req.resolved_url)
+        return req.resolved_url
+
+    def request(self, url):
+        resolved_url = None
+        if self.link_cache and self.link_cache.is_short(url):
+            resolved_url = self.link_cache.get(url)
+        req = self.fetch(url, None, resolved_url)
         return (req.resolved_url, req.recv_data)
+
+    def fetch(self, url, validators=None, resolved_url=None, acquired=False):
+        """抓取网页并返回HttpRequest, validators为上次抓取时的(ETag, Last-Modified),
+        网页未改变时返回的HttpRequest.not_modified为True;
+        resolved_url为调用者从link_cache中查到的短链接目标地址, 这里不再查询;
+        acquired为True时调用者已经为第一个请求(resolved_url或url)消耗了令牌"""
+        target_url = url
+        is_short = bool(self.link_cache) and self.link_cache.is_short(url)
+        if is_short:
+            # go straight to the cached target instead of the short link server
+            if (not resolved_url) and (self.cfg_link_resolve_mode == 'head'):
+                resolved_url = self.resolve(url, acquired)
+                acquired = False
+            if resolved_url:
+                if not ghost_url_filter.is_html_url(resolved_url):
+                    req = self._build_request(url)
+                    req.resolved_url = resolved_url
+                    req.error = 'ERR: non html url'
+                    return req
+                target_url = resolved_url
+        req = self._build_request(target_url)
+        req.validators = validators
+        self._commit_request(req, acquired)
+        if req.codec and not req.error:
+            with self.stats_lock:
+                stats = self.codec_stats.setdefault(req.codec, [0, 0, 0])
+                stats[0] += 1
+                stats[1] += req.raw_size
+                stats[2] += req.data_size
+        if req.error:
+            self.log.write(req.dump())
+        elif is_short and (target_url == url):
+            self.link_cache.update(url, req.resolved_url)
+        return req
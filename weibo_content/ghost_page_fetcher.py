@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#-------------------------------------------------------------------------
+#
+# 后台网页抓取线程池
+#
+# 链接按域名排队, 工作线程在各域名之间轮流取链接, 同一域名同时抓取的
+# 链接数不超过host_limit, 相邻两次抓取至少间隔host_delay秒, 避免大量
+# t.cn短链接集中请求同一个域名而被限流, 其它域名的链接也不必等待。
+# 可以抓取的域名中, 由RateLimiter.next_ready()挑出令牌已就绪的一个,
+# 令牌都未就绪时工作线程等到最先就绪的时间, 而不是在某个域名上等待。
+#
+# 微博时间线抓取线程只负责提交链接, 网页由工作线程并发抓取, 抓取结果
+# 由调用者通过poll()取回后写入PageStore, 因此PageStore无需加锁。
+# 等待抓取的链接数超过上限时submit()返回False, 调用者据此丢弃链接,
+# 不会因为网页抓取缓慢而阻塞时间线的抓取。
+#
+#-------------------------------------------------------------------------
+
+import time
+import heapq
+import threading
+import collections
+import urllib.parse
+
+__all__ = ['PageFetcher']
+
+class PageFetcher:
+
+    def __init__(self, page_crawler, log):
+        self.page_crawler = page_crawler
+        self.log = log
+        self.num_workers = 4        # 工作线程数
+        self.max_queued = 1000      # 等待抓取的链接数上限
+        self.host_limit = 2         # 每个域名同时抓取的链接数上限
+        self.host_delay = 0         # 同一域名相邻两次抓取的最小间隔(单位:秒)
+        self.host_queues = { }      # key:host, value:deque of (url, timestamp, validators, resolved_url)
+        self.host_active = { }      # key:host, value:正在抓取的链接数
+        self.host_next_time = { }   # key:host, value:下一次允许抓取的时间
+        self.ready_hosts = collections.deque()  # 可以立即抓取的域名, 按轮转顺序排列
+        self.delayed_hosts = [ ]    # heap of (time, host), 等待最小间隔的域名
+        self.scheduled = set()      # 在ready_hosts或delayed_hosts中的域名
+        self.pending = set()        # 排队或正在抓取的链接
+        self.results = collections.deque()
+        self.num_queued = 0
+        self.num_rejected = 0       # 因队列已满而拒绝的链接数
+        self.cond = threading.Condition()
+        self.threads = [ ]
+
+    def start(self):
+        for i in range(self.num_workers):
+            thread = threading.Thread(target=self._run, name='page-fetcher-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _host(self, url):
+        return (urllib.parse.urlsplit(url).hostname or '').lower()
+
+    def _pick_ready_host(self):
+        # must be called with self.cond held, returns (host, wait)
+        rate_limiter = self.page_crawler.rate_limiter
+        candidates = [ ]
+        for host in self.ready_hosts:
+            url, timestamp, validators, resolved_url = self.host_queues[host][0]
+            candidates.append(self.page_crawler.rate_keys(resolved_url or url))
+        index, wait = rate_limiter.next_ready(candidates)
+        if wait > 0:
+            return (None, wait)
+        host = self.ready_hosts[index]
+        del self.ready_hosts[index]
+        return (host, 0)
+
+    def submit(self, url, timestamp, validators=None, resolved_url=None):
+        """提交链接, 队列已满时返回False, validators和resolved_url原样传给PageCrawler.fetch()"""
+        with self.cond:
+            if url in self.pending:
+                return True
+            if self.num_queued >= self.max_queued:
+                self.num_rejected += 1
+                return False
+            # queued by the host of the first request, the short link target if known
+            host = self._host(resolved_url or url)
+            self.host_queues.setdefault(host, collections.deque()).append((url, timestamp, validators, resolved_url))
+            self.pending.add(url)
+            self.num_queued += 1
+            self._schedule(host)
+            return True
+
+    def poll(self):
+        """取回已完成的抓取结果, 返回[(url, HttpRequest, timestamp)], 抓取异常时HttpRequest为None"""
+        results = [ ]
+        while self.results:
+            results.append(self.results.popleft())
+        return results
+
+    def dump(self):
+        with self.cond:
+            num_active = sum(self.host_active.values())
+            return 'PAGE FETCH queued=%d active=%d rejected=%d' % \
+                   (self.num_queued, num_active, self.num_rejected)
+
+    def _schedule(self, host):
+        # must be called with self.cond held
+        if host in self.scheduled:
+            return
+        if not self.host_queues.get(host):
+            return
+        if self.host_active.get(host, 0) >= self.host_limit:
+            return
+        self.scheduled.add(host)
+        next_time = self.host_next_time.get(host, 0)
+        if next_time > time.time():
+            heapq.heappush(self.delayed_hosts, (next_time, host))
+        else:
+            self.ready_hosts.append(host)
+        self.cond.notify()
+
+    def _next(self):
+        with self.cond:
+            while True:
+                now = time.time()
+                while self.delayed_hosts and (self.delayed_hosts[0][0] <= now):
+                    next_time, host = heapq.heappop(self.delayed_hosts)
+                    self.ready_hosts.append(host)
+                timeout = None
+                if self.ready_hosts:
+                    host, timeout = self._pick_ready_host()
+                    if host != None:
+                        break
+                if self.delayed_hosts:
+                    delay = self.delayed_hosts[0][0] - now
+                    if (timeout == None) or (delay < timeout):
+                        timeout = delay
+                self.cond.wait(timeout)
+            self.scheduled.discard(host)
+            url, timestamp, validators, resolved_url = self.host_queues[host].popleft()
+            self.num_queued -= 1
+            self.host_active[host] = self.host_active.get(host, 0) + 1
+            if self.host_delay > 0:
+                self.host_next_time[host] = now + self.host_delay
+            self._schedule(host)
+            return (host, url, timestamp, validators, resolved_url)
+
+    def _prune_next_time(self):
+        # must be called with self.cond held
+        if len(self.host_next_time) <= 2 * len(self.host_queues) + 64:
+            return
+        now = time.time()
+        for host, next_time in list(self.host_next_time.items()):
+            if (next_time <= now) and (host not in self.host_queues):
+                del self.host_next_time[host]
+
+    def _done(self, host, url, result):
+        with self.cond:
+            self.results.append(result)
+            self.pending.discard(url)
+            self.host_active[host] -= 1
+            if self.host_active[host] == 0:
+                del self.host_active[host]
+            if not self.host_queues[host]:
+                if host not in self.host_active:
+                    del self.host_queues[host]
+                    self._prune_next_time()
+            else:
+                self._schedule(host)
+
+    def _run(self):
+        while True:
+            host, url, timestamp, validators, resolved_url = self._next()
+            try:
+                # the token of the first request was taken by _next()
+                req = self.page_crawler.fetch(url, validators, resolved_url, True)
+            except Exception as err:
+                self.log.write('ERR: page fetch exception, url=%s, value=%s' % (url, err))
+                req = None
+            self._done(host, url, (url, req, timestamp))
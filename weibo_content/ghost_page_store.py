@@ -3,11 +3,16 @@
 
 import os
 import re
-import io
 import sys
 import time
+import zlib
 import codecs
+import struct
+import hashlib
 import zipfile
+import collections
+
+import ghost_url_filter
 
 __all__ = ['PageStore']
 
@@ -15,16 +20,29 @@ class PageStore:
 
     CACHE_FILE_NAME = 'page_store_cache.txt'
 
-    CACHE_ITEM_PATTERN = re.compile(r'^(?P<timestamp>[0-9]+)\s+(?P<url>.+)', re.MULTILINE)
+    # timestamp url[\tETag\tLast-Modified]
+    CACHE_ITEM_PATTERN = re.compile(r'^(?P<timestamp>[0-9]+)\s+(?P<url>[^\t\r\n]+)' \
+        r'(?:\t(?P<etag>[^\t\r\n]*)\t(?P<last_modified>[^\t\r\n]*))?', re.MULTILINE)
+
+    # 正在写入的分段文件, flush时改名为 <name>_page.zip
+    # 每个网页保存为 <id>.url 和 <id>.htm 两个条目, 若同一分段中已有相同
+    # 内容的网页, 用 <id>.ref 记录已有的 .htm 条目名, 代替 <id>.htm
+    # HTTP头Content-Type中的字符集保存在 .htm 条目的注释中, 如 b'charset=gbk'
+    # 分段文件在保存第一个网页时才创建, 异常退出后留下的分段文件在下次
+    # 启动时恢复为 <segment>_page.zip, 没有网页的分段文件直接删除
+    SEGMENT_FILE_SUFFIX = '_page.zip.part'
 
     def __init__(self, config, log):
         self.config = config
         self.log = log
         self._load_settings()
-        self.cache_list = [ ]
-        self.cache_dict = { }
+        self._recover_segments()
+        self.cache_dict = collections.OrderedDict()   # 按最近更新时间排序, 最早的在前
+        self.validator_dict = { }   # key:url, value:(ETag, Last-Modified), 只保存cache_dict中的url
         self._load_cache()
         self.next_page_id = int(time.time())
+        self.num_dup_pages = 0      # 与本分段中已保存的网页内容相同的网页数
+        self.num_dup_bytes = 0
         self._reset_zip_file()
 
     def _load_settings(self):
@@ -52,56 +70,200 @@ class PageStore:
         self.cache_size = self.config.get_int(key, 100)
 
     def _reset_zip_file(self):
-        self.mem_file = io.BytesIO()
-        self.zip_file = zipfile.ZipFile(self.mem_file, mode='w', \
-            compression=zipfile.ZIP_DEFLATED)
+        # 页面直接压缩写入磁盘上的分段文件, 内存占用与批次大小无关
+        self.digest_dict = { }      # key:网页内容摘要, value:本分段中保存该内容的条目名
+        self.zip_file = None
+        self.segment_path = None
+
+    def _open_zip_file(self):
+        name = '%012d' % self.next_page_id
+        self.segment_path = os.path.join(self.store_path, name + self.SEGMENT_FILE_SUFFIX)
+        try:
+            self.zip_file = zipfile.ZipFile(self.segment_path, mode='w', \
+                compression=zipfile.ZIP_DEFLATED)
+        except (OSError, IOError):
+            self.log.write('ERR: failed to save %s' % self.segment_path)
+            self.zip_file = None
+            return False
+        return True
+
+    def _close_broken_zip_file(self):
+        # the segment is left on disk, its complete entries are recovered on the next start
+        try:
+            self.zip_file.close()
+        except (OSError, IOError, ValueError):
+            pass
+        self._reset_zip_file()
+
+    def _recover_segments(self):
+        for file_name in sorted(os.listdir(self.store_path)):
+            if not file_name.endswith(self.SEGMENT_FILE_SUFFIX):
+                continue
+            part_path = os.path.join(self.store_path, file_name)
+            path = os.path.join(self.store_path, file_name[:-len(self.SEGMENT_FILE_SUFFIX)] + '_page.zip')
+            try:
+                num_pages = self._recover_segment(part_path, path)
+            except (OSError, IOError):
+                self.log.write('ERR: failed to recover %s' % part_path)
+            else:
+                if num_pages:
+                    self.log.write('page store: %d pages recovered, save file %s' % (num_pages, path))
+                else:
+                    self.log.write('page store: removed empty segment %s' % part_path)
+
+    def _recover_segment(self, part_path, path):
+        """把分段文件恢复为path, 返回恢复的网页数, 没有网页时删除分段文件"""
+        try:
+            with zipfile.ZipFile(part_path) as zip_file:
+                num_pages = len([n for n in zip_file.namelist() if n.endswith(('.htm', '.ref'))])
+        except zipfile.BadZipFile:
+            pass
+        else:
+            if not num_pages:
+                os.remove(part_path)
+                return 0
+            # closed but not renamed
+            os.replace(part_path, path)
+            return num_pages
+        # no central directory, the local entry headers are written in order
+        # and carry their sizes, keep every complete entry; the charset
+        # comments only live in the central directory and are lost
+        entries = self._read_local_entries(part_path)
+        ids = set([n[:-4] for n, data, date_time in entries if n.endswith(('.htm', '.ref'))])
+        entries = [e for e in entries if e[0][:-4] in ids]
+        if not ids:
+            os.remove(part_path)
+            return 0
+        with zipfile.ZipFile(path, mode='w', compression=zipfile.ZIP_DEFLATED) as zip_file:
+            for name, data, date_time in entries:
+                info = zipfile.ZipInfo(name, date_time=date_time)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                zip_file.writestr(info, data)
+        os.remove(part_path)
+        return len(ids)
+
+    def _read_local_entries(self, part_path):
+        """返回分段文件中完整的条目[(name, data, date_time)], 遇到不完整的条目为止"""
+        entries = [ ]
+        with open(part_path, 'rb') as f:
+            while True:
+                header = f.read(zipfile.sizeFileHeader)
+                if len(header) < zipfile.sizeFileHeader:
+                    break
+                fields = struct.unpack(zipfile.structFileHeader, header)
+                if fields[0] != zipfile.stringFileHeader:
+                    break
+                flag_bits, compress_type, t, d, crc, compress_size, file_size, name_size, extra_size = fields[3:]
+                name = f.read(name_size)
+                f.read(extra_size)
+                raw_data = f.read(compress_size)
+                if (len(name) < name_size) or (len(raw_data) < compress_size):
+                    break
+                try:
+                    if compress_type == zipfile.ZIP_DEFLATED:
+                        data = zlib.decompress(raw_data, -15)
+                    else:
+                        data = raw_data
+                except zlib.error:
+                    break
+                if (len(data) != file_size) or (zlib.crc32(data) != crc):
+                    break
+                name = name.decode('utf_8' if flag_bits & 0x800 else 'cp437')
+                date_time = ((d >> 9) + 1980, (d >> 5) & 0xF, d & 0x1F, t >> 11, (t >> 5) & 0x3F, (t & 0x1F) * 2)
+                entries.append((name, data, date_time))
+        return entries
         
     def get_timestamp(self, url):
+        url = ghost_url_filter.canonicalize_url(url)
         if url in self.cache_dict:
             return self.cache_dict[url]
         else:
             return 0
     
-    def update(self, url, page_data, timestamp):
-        if url in self.cache_dict:
-            self.cache_dict[url] = timestamp
-            self.cache_list.remove(url)
-            self.cache_list.append(url)
+    def get_validators(self, url):
+        """返回上次抓取该网页时的(ETag, Last-Modified), 没有时返回None"""
+        return self.validator_dict.get(ghost_url_filter.canonicalize_url(url))
+
+    def update(self, url, page_data, timestamp, validators=None, charset=None):
+        if page_data and not self._save_page(url, page_data, charset):
+            # the page is dropped, leave the cache alone so that it is fetched again
+            return
+        key = ghost_url_filter.canonicalize_url(url)
+        if key in self.cache_dict:
+            self.cache_dict[key] = timestamp
+            self.cache_dict.move_to_end(key)
         else:
-            self.cache_dict[url] = timestamp
-            self.cache_list.append(url)
+            self.cache_dict[key] = timestamp
             if len(self.cache_dict) > self.cache_size:
-                oldest = self.cache_list.pop(0)
-                del self.cache_dict[oldest]
-        if page_data:
-            name = '%012d' % self.next_page_id
-            self.next_page_id += 1
-            meta_data = url.encode('utf_8', errors='ignore')
+                oldest, oldest_timestamp = self.cache_dict.popitem(last=False)
+                self.validator_dict.pop(oldest, None)
+        if validators:
+            self.validator_dict[key] = validators
+        elif page_data:
+            # new content without validators, the old ones are stale
+            self.validator_dict.pop(key, None)
+
+    def _save_page(self, url, page_data, charset):
+        """返回是否保存成功"""
+        if (self.zip_file is None) and not self._open_zip_file():
+            return False
+        name = '%012d' % self.next_page_id
+        self.next_page_id += 1
+        meta_data = url.encode('utf_8', errors='ignore')
+        digest = hashlib.blake2b(page_data, digest_size=16).digest()
+        ref_name = self.digest_dict.get(digest)
+        try:
             self.zip_file.writestr(name + '.url', meta_data)
-            self.zip_file.writestr(name + '.htm', page_data)
-            
+            if ref_name:
+                # same content already in this segment, store a reference to its entry
+                self.zip_file.writestr(name + '.ref', ref_name.encode('ascii'))
+                self.num_dup_pages += 1
+                self.num_dup_bytes += len(page_data)
+            else:
+                info = zipfile.ZipInfo(name + '.htm', date_time=time.localtime()[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                if charset:
+                    info.comment = ('charset=' + charset).encode('ascii', errors='ignore')
+                self.zip_file.writestr(info, page_data)
+                self.digest_dict[digest] = name + '.htm'
+        except (OSError, IOError):
+            self.log.write('ERR: failed to save %s' % self.segment_path)
+            self._close_broken_zip_file()
+            return False
+        return True
+
     def flush(self, name):
         path = os.path.join(self.store_path, name + '_page.zip')
+        self.log.write('page store: %d duplicated pages, %d bytes saved' % (self.num_dup_pages, self.num_dup_bytes))
+        self.num_dup_pages = 0
+        self.num_dup_bytes = 0
         self._flush_store(path)
         self._save_cache()
+        self._reset_zip_file()
         
     def _flush_store(self, path):
-        self.zip_file.close()
-        data = self.mem_file.getbuffer()
+        if self.zip_file is None:
+            self.log.write('page store: no page to save')
+            return
         try:
-            open(path, 'w+b').write(data)
+            self.zip_file.close()
+            os.replace(self.segment_path, path)
         except (OSError, IOError):
+            # the segment is left on disk and recovered on the next start
             self.log.write('ERR: failed to save %s' % path)
         else:
             self.log.write('page store: save file %s' % path)
-        self._reset_zip_file()
 
     def _save_cache(self):
         path = self.cache_file_path
         chunks = [ ]
-        for url in self.cache_list:
-            timestamp = self.cache_dict[url]
-            chunks.append('%d %s\n' % (timestamp, url))
+        for url, timestamp in self.cache_dict.items():
+            validators = self.validator_dict.get(url)
+            if validators:
+                etag, last_modified = validators
+                chunks.append('%d %s\t%s\t%s\n' % (timestamp, url, etag or '', last_modified or ''))
+            else:
+                chunks.append('%d %s\n' % (timestamp, url))
         text = ''.join(chunks)
         data = text.encode('utf_8', errors='ignore')
         try:
@@ -123,11 +285,79 @@ class PageStore:
             self.log.write('page store cache: load file %s' % path)
         text = data.decode('utf_8', errors='ignore')
         for match in self.CACHE_ITEM_PATTERN.finditer(text):
-            url = match.group('url')
+            url = ghost_url_filter.canonicalize_url(match.group('url'))
             timestamp = int(match.group('timestamp'))
             if not (url in self.cache_dict):
                 self.cache_dict[url] = timestamp
-                self.cache_list.append(url)
+                if match.group('etag') or match.group('last_modified'):
+                    self.validator_dict[url] = (match.group('etag') or None, match.group('last_modified') or None)
                 if len(self.cache_dict) >= self.cache_size:
                     break
         self.log.write('page store cache: %d items loaded' % len(self.cache_dict))
+
+if __name__ == '__main__':
+
+    # benchmark: replay a skewed stream of short urls through get_timestamp
+    # and update the way Ghost._handle_message_data does, compared with the
+    # former list based LRU (list.remove + list.pop(0))
+
+    import random
+    import tempfile
+
+    import ghost_log
+    import ghost_config
+
+    class ListPageStore(PageStore):
+
+        def __init__(self, config, log):
+            PageStore.__init__(self, config, log)
+            self.cache_dict = { }
+            self.cache_list = [ ]
+
+        def update(self, url, page_data, timestamp):
+            # same key as PageStore.update, so that only the LRU differs
+            url = ghost_url_filter.canonicalize_url(url)
+            if url in self.cache_dict:
+                self.cache_dict[url] = timestamp
+                self.cache_list.remove(url)
+                self.cache_list.append(url)
+            else:
+                self.cache_dict[url] = timestamp
+                self.cache_list.append(url)
+                if len(self.cache_dict) > self.cache_size:
+                    oldest = self.cache_list.pop(0)
+                    del self.cache_dict[oldest]
+
+    cache_size = 100000
+    if len(sys.argv) > 1:
+        cache_size = int(sys.argv[1])
+    expired_time = 2 * 24 * 60 * 60
+
+    temp_path = tempfile.mkdtemp()
+    config_path = os.path.join(temp_path, 'ghost.ini')
+    lines = [ ]
+    for key in ('sys_file_path', 'log_file_path', 'out_file_path'):
+        lines.append('"%s" = "%s"' % (key, temp_path))
+    lines.append('"page_cache_size" = "%d"' % cache_size)
+    open(config_path, 'w').write('\n'.join(lines))
+    config = ghost_config.Config(config_path)
+    log = ghost_log.Log(config)
+
+    # popular links are shared over and over, most links are seen once
+    rand = random.Random(0)
+    num_urls = cache_size * 3
+    stream = [ ]
+    for i in range(cache_size * 2):
+        n = int(rand.paretovariate(0.8)) % num_urls
+        stream.append(('http://t.cn/%08x' % n, 1400000000 + i * 600))
+
+    for name, cls, count in (('ordered', PageStore, len(stream)), ('list', ListPageStore, len(stream) // 20)):
+        store = cls(config, log)
+        for i in range(cache_size):
+            store.update('http://t.cn/fill%08x' % i, None, 1300000000)
+        start = time.perf_counter()
+        for url, timestamp in stream[:count]:
+            if timestamp - store.get_timestamp(url) >= expired_time:
+                store.update(url, None, timestamp)
+        elapsed = time.perf_counter() - start
+        print('%-8s cache %d: %.0f urls/s (%d urls)' % (name, cache_size, count / elapsed, count))
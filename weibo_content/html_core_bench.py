@@ -0,0 +1,210 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#-------------------------------------------------------------------------
+#
+# HTMLDumpParser性能测试
+#
+# 语料为PageStore输出的 *_page.zip 或保存了 .htm 文件的目录, 分别用
+# 当前的解析器和之前的实现提取全部网页, 比较耗时并检查输出是否一致;
+# 同时给出流式解析器HTMLStreamDumpParser的耗时和与之输出不同的网页数。
+# 流式解析器跳过script/style/导航栏/页脚等子树, 输出不同是预期的; 关闭
+# 跳过后, 在批量解析器找到并关闭了<body>的网页上两者的输出应当一致。
+#
+# 指定 --memory 时改为用tracemalloc统计每个网页解析过程中的内存峰值,
+# 比较带__dict__的记号、__slots__记号和流式解析器。
+#
+#-------------------------------------------------------------------------
+
+import os
+import re
+import sys
+import time
+import zipfile
+import tracemalloc
+
+import html_core_dump
+
+def load_corpus(path):
+    pages = [ ]
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.endswith(('.htm', '.html')):
+                pages.append(open(os.path.join(path, name), 'rb').read())
+    else:
+        with zipfile.ZipFile(path) as zip_file:
+            for name in zip_file.namelist():
+                if name.endswith('.htm'):
+                    pages.append(zip_file.read(name))
+    return pages
+
+class LegacyHTMLDumpParser(html_core_dump.HTMLDumpParser):
+    """打分部分为之前的实现: 每次打分都通过re模块查找属性, 用re.findall统计标点"""
+
+    def update_token_score(self, t):
+        if not (t.name in {'p', 'div'}):
+            return
+        if t.parent == None:
+            return
+        parent = self.tokens[t.parent]
+        if parent.score == 'undefined':
+            parent.score = 0
+            if re.search(r'comment|meta|footer|footnote|页脚|注释|备注', parent.attrs, re.IGNORECASE):
+                parent.score -= 50
+            if re.search(r'post|entry|content|text|body|article', parent.attrs, re.IGNORECASE):
+                parent.score += 25
+        for i in t.children:
+            child = self.tokens[i]
+            if child.is_text():
+                parent.score += len(re.findall('，|。|？|！|、|：|；|,', child.text))
+
+SlotsToken = html_core_dump.Token
+TAG_TEXT = html_core_dump.TAG_TEXT
+
+class DictToken:
+    """之前的记号: 没有__slots__, 每个实例带__dict__和children列表
+
+    不能继承Token, 否则属性仍然保存在继承的slots中
+    """
+
+    def __init__(self, tag, name):
+        assert((name == tag) or (name == '/' + tag))
+        self.tag = tag
+        self.name = name
+        self.text = ''
+        self.attrs = ''
+        self.score = 'undefined'
+        self.line_num = 0
+        self.line_pos = 0
+        self.parent = None
+        self.children = [ ]
+        self.index = -1
+        self.end_tag_index = -1
+
+    def is_end(self):
+        return self.name[0] == '/'
+
+    def is_text(self):
+        return self.name == TAG_TEXT
+
+    def set_attrs(self, attrs):
+        chunks = [ ]
+        for key, val in attrs:
+            if (key == 'id') or (key == 'class'):
+                chunks.append(val)
+        self.attrs = ' '.join(chunks)
+
+    def count_sentence(self):
+        return html_core_dump.count_sentence(self.text)
+
+def measure_memory(cls, pages):
+    """返回每个网页解析过程中内存峰值的(平均值, 最大值)"""
+    peaks = [ ]
+    for data in pages:
+        parser = cls()
+        text = parser.decode_html_text(data)
+        tracemalloc.start()
+        parser.dump_text(text)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return (sum(peaks) / len(peaks), max(peaks))
+
+def run(cls, pages):
+    """返回(输出列表, 总耗时, 打分耗时)"""
+    outputs = [ ]
+    total_time = 0.0
+    score_time = 0.0
+    for data in pages:
+        parser = cls()
+        start = time.perf_counter()
+        text = parser.decode_html_text(data)
+        parser.parse_tokens(text)
+        parser.build_title_text()
+        score_start = time.perf_counter()
+        parser.build_body_text()
+        end = time.perf_counter()
+        total_time += end - start
+        score_time += end - score_start
+        outputs.append((parser.title_text, parser.body_text))
+    return (outputs, total_time, score_time)
+
+class NoSkipStreamDumpParser(html_core_dump.HTMLStreamDumpParser):
+    """不跳过任何子树的流式解析器, 用于和批量解析器比较"""
+
+    SKIP_TAGS = set()
+    SKIP_ATTRS_TAGS = set()
+
+def run_stream(pages, cls=html_core_dump.HTMLStreamDumpParser):
+    """返回(输出列表, 总耗时)"""
+    outputs = [ ]
+    total_time = 0.0
+    for data in pages:
+        parser = cls()
+        start = time.perf_counter()
+        text = parser.decode_html_text(data)
+        parser.dump_text(text)
+        total_time += time.perf_counter() - start
+        outputs.append((parser.title_text, parser.body_text))
+    return (outputs, total_time)
+
+if __name__ == '__main__':
+
+    args = sys.argv[1:]
+    memory = False
+    if args and (args[0] == '--memory'):
+        memory = True
+        args = args[1:]
+    if len(args) != 1:
+        print('usage: html_core_bench [--memory] page_zip_file|html_dir')
+        sys.exit(0)
+
+    pages = load_corpus(args[0])
+    if not pages:
+        print('Error: no page found')
+        sys.exit(1)
+    num_bytes = sum([len(p) for p in pages])
+    print('corpus: %d pages, %.2f MB' % (len(pages), num_bytes / 1048576))
+
+    if memory:
+        for name, cls, token_cls in (('dict', html_core_dump.HTMLDumpParser, DictToken), \
+                                     ('slots', html_core_dump.HTMLDumpParser, SlotsToken), \
+                                     ('stream', html_core_dump.HTMLStreamDumpParser, SlotsToken)):
+            html_core_dump.Token = token_cls
+            try:
+                mean_peak, max_peak = measure_memory(cls, pages)
+            finally:
+                html_core_dump.Token = SlotsToken
+            print('%-8s peak memory per page: mean %.1f KB, max %.1f KB' % (name, mean_peak / 1024, max_peak / 1024))
+        sys.exit(0)
+
+    results = { }
+    for name, cls in (('legacy', LegacyHTMLDumpParser), ('current', html_core_dump.HTMLDumpParser)):
+        outputs, total_time, score_time = run(cls, pages)
+        results[name] = outputs
+        print('%-8s %.1f pages/s, %.2f MB/s, build_body_text %.3f s of %.3f s' % \
+              (name, len(pages) / total_time, num_bytes / total_time / 1048576, score_time, total_time))
+    if results['legacy'] != results['current']:
+        print('Error: outputs differ')
+        sys.exit(1)
+
+    outputs, total_time = run_stream(pages)
+    num_diff = len([1 for a, b in zip(outputs, results['current']) if a != b])
+    print('%-8s %.1f pages/s, %.2f MB/s, %d pages differ from current (skipped subtrees, expected)' % \
+          ('stream', len(pages) / total_time, num_bytes / total_time / 1048576, num_diff))
+
+    # without skipping, the only difference left is a <body> never closed:
+    # the batch parser then leaves out the last text of the page
+    outputs, total_time = run_stream(pages, NoSkipStreamDumpParser)
+    num_diff = 0
+    for data, a, b in zip(pages, outputs, results['current']):
+        if a != b:
+            parser = html_core_dump.HTMLDumpParser()
+            parser.parse_tokens(parser.decode_html_text(data))
+            parser.build_body_text()
+            if (parser.root.name == 'body') and (parser.root.end_tag_index >= 0):
+                num_diff += 1
+    print('%-8s %.1f pages/s, %.2f MB/s, %d pages with closed <body> differ from current' % \
+          ('noskip', len(pages) / total_time, num_bytes / total_time / 1048576, num_diff))
+    if num_diff:
+        print('Error: outputs differ')
+        sys.exit(1)
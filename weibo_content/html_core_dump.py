@@ -16,9 +16,15 @@ class HTMLTextDecoder:
         self.verbose = False
         self.default_encoding = 'utf_8'
         self.resolved_encoding = 'utf_8'
+        self.sniff_size = 4096      # 只在开头的这些字节中查找<meta>标签的charset
 
-    def decode(self, data):
+    def decode(self, data, charset=None):
+        """charset为HTTP头Content-Type中的字符集, 优先级低于BOM, 高于<meta>标签"""
         encoding, data = self._detect_encoding_by_bom(data)
+        if (not encoding) and charset:
+            encoding = self._lookup_encoding(charset)
+            if (not encoding) and self.verbose:
+                print('Warning: unknown charset "%s" in Content-Type' % charset)
         if not encoding:
             encoding = self._detect_encoding_by_charset(data)
         if not encoding:
@@ -40,28 +46,28 @@ class HTMLTextDecoder:
         else:
             return (None, data)
         
+    # <meta http-equiv="Content-Type" content="text/html; charset=gbk">
+    # <meta charset="utf-8">
     HTML_CHARSET = re.compile( \
-        br'<meta' \
-        br'[^>]*?http[^>]*?equiv[^>]*?content[^>]*?type' \
-        br'[^>]*?content[^>]*?text[^>]*?html[^>]*?charset\s*=\s*(?P<charset>[_\-0-9a-z]+)' \
-        br'[^>]*?>', \
+        br'<meta[^>]*?charset\s*=\s*[\'"]?(?P<charset>[_\-0-9a-z]+)', \
         re.IGNORECASE)
 
+    # gb2312和gbk都按其超集gb18030解码, 不会丢失gbk之外的字符
     CHARSET_TO_ENCODING = {
         'utf8'      : 'utf_8',
         'u8'        : 'utf_8',
-        'gbk'       : 'gbk',
-        'gb'        : 'gbk',
-        'gb2312'    : 'gbk',
-        'gb231280'  : 'gbk',
-        'gb18030'   : 'gbk',
-        'csgb'      : 'gbk',
-        'hzgb'      : 'gbk',
-        'hzgb2312'  : 'gbk',
-        'hzgbk'     : 'gbk',
-        '936'       : 'gbk',
-        'cp936'     : 'gbk',
-        'ms936'     : 'gbk',
+        'gbk'       : 'gb18030',
+        'gb'        : 'gb18030',
+        'gb2312'    : 'gb18030',
+        'gb231280'  : 'gb18030',
+        'gb18030'   : 'gb18030',
+        'csgb'      : 'gb18030',
+        'hzgb'      : 'gb18030',
+        'hzgb2312'  : 'gb18030',
+        'hzgbk'     : 'gb18030',
+        '936'       : 'gb18030',
+        'cp936'     : 'gb18030',
+        'ms936'     : 'gb18030',
         'big5'      : 'big5',
         'big5tw'    : 'big5',
         'csbig5'    : 'big5',
@@ -79,19 +85,33 @@ class HTMLTextDecoder:
         'u32be'     : 'utf_32_be',
         }
     
+    # key:charset, value:encoding or None, shared by all decoders
+    ENCODING_CACHE = { }
+
+    def _lookup_encoding(self, charset):
+        if charset in self.ENCODING_CACHE:
+            return self.ENCODING_CACHE[charset]
+        name = re.sub('[^0-9a-z]+', '', charset.lower())
+        if name in self.CHARSET_TO_ENCODING:
+            encoding = self.CHARSET_TO_ENCODING[name]
+        else:
+            try:
+                info = codecs.lookup(charset)
+                # hex, base64, zlib, rot13 etc. are codecs too but do not decode bytes to text
+                encoding = info.name if info._is_text_encoding else None
+            except LookupError:
+                encoding = None
+        if len(self.ENCODING_CACHE) < 1024:
+            self.ENCODING_CACHE[charset] = encoding
+        return encoding
+
     def _detect_encoding_by_charset(self, data):
-        match = self.HTML_CHARSET.search(data)
+        match = self.HTML_CHARSET.search(data, 0, self.sniff_size)
         if match:
             charset = match.group('charset').decode('ascii')
-            name = re.sub('[^0-9a-z]+', '', charset.lower())
-            if name in self.CHARSET_TO_ENCODING:
-                return self.CHARSET_TO_ENCODING[name]
-            try:
-                data.decode(charset, errors='ignore')
-            except LookupError:
-                pass
-            else:
-                return charset
+            encoding = self._lookup_encoding(charset)
+            if encoding:
+                return encoding
             if self.verbose:
                 print('Warning: unknown charset "%s"' % charset)
         else:
@@ -110,6 +130,10 @@ class ParserError(Exception):
         
 class Token:
 
+    # a page yields tens of thousands of tokens, keep them small
+    __slots__ = ('tag', 'name', 'text', 'attrs', 'score', 'line_num', 'line_pos', \
+                 'parent', 'children', 'index', 'end_tag_index')
+
     def __init__(self, tag, name):
         assert((name == tag) or (name == '/' + tag))
         self.tag = tag
@@ -120,7 +144,7 @@ class Token:
         self.line_num = 0
         self.line_pos = 0
         self.parent = None
-        self.children = [ ]
+        self.children = ()              # 子节点下标, 第一个子节点加入时才创建列表
         self.index = -1
         self.end_tag_index = -1
 
@@ -144,8 +168,12 @@ class Token:
         self.attrs = ' '.join(chunks)
 
     def count_sentence(self):
-        # 常见中文标点符号 + 西文句号
-        return len(re.findall('，|。|？|！|、|：|；|,', self.text))
+        return count_sentence(self.text)
+
+def count_sentence(text):
+    # 常见中文标点符号 + 西文句号, str.count比正则表达式和str.translate都快
+    return text.count('，') + text.count('。') + text.count('？') + text.count('！') + \
+           text.count('、') + text.count('：') + text.count('；') + text.count(',')
     
 class HTMLDumpParser(html.parser.HTMLParser):
 
@@ -154,28 +182,32 @@ class HTMLDumpParser(html.parser.HTMLParser):
         self.debug = None   # debug output file path
         self.verbose = False
 
-    def decode_html_text(self, data):
+    def decode_html_text(self, data, charset=None):
         decoder = HTMLTextDecoder()
         decoder.verbose = self.verbose
-        return decoder.decode(data)
+        return decoder.decode(data, charset)
 
     def encode_html_text(self, text):
         return text.encode('utf_8', errors='replace')
 
-    def dump_raw(self, data):
-        text = self.decode_html_text(data)
+    def dump_raw(self, data, charset=None):
+        """charset为HTTP头Content-Type中的字符集, 可以为None"""
+        text = self.decode_html_text(data, charset)
         text = self.dump_text(text)
         return self.encode_html_text(text)
 
     def dump_text(self, text):
         self.parse_tokens(text)
         self.build_title_text()
+        self.build_body_text()
+        return self.format_text()
+
+    def format_text(self):
         chunks = [ ]
         if self.title_text:
             chunks.append('<%%title%%>')
             chunks.append(self.title_text)
             chunks.append('</%%title%%>')
-        self.build_body_text()
         if self.body_text:
             chunks.append('<%%body%%>')
             chunks.append(self.body_text)
@@ -211,13 +243,15 @@ class HTMLDumpParser(html.parser.HTMLParser):
 
         # assign score for tokens
 
-        for t in self.tokens[self.root.index : self.root.end_tag_index]:
-            self.update_token_score(t)
+        body_tokens = self.tokens[self.root.index : self.root.end_tag_index]
+        for t in body_tokens:
+            if t.name in self.SCORE_TAGS:
+                self.update_token_score(t)
 
         # find token with maximum score
 
         top = None
-        for t in self.tokens[self.root.index : self.root.end_tag_index]:
+        for t in body_tokens:
             if t.score != 'undefined':
                 if (top == None) or (t.score > top.score):
                     top = t
@@ -226,10 +260,7 @@ class HTMLDumpParser(html.parser.HTMLParser):
         
         # generate text
 
-        chunks = [ ]
-        for t in self.tokens[top.index : top.end_tag_index]:
-            if t.is_text():
-                chunks.append(t.text)
+        chunks = [t.text for t in self.tokens[top.index : top.end_tag_index] if t.name == TAG_TEXT]
         self.body_text = '\n'.join(chunks)
 
         if self.debug:
@@ -242,23 +273,35 @@ class HTMLDumpParser(html.parser.HTMLParser):
             data = text.encode('utf_8', errors='replace')
             open(self.debug + '_tokens.txt', 'wb').write(data)
             
+    NEGATIVE_ATTRS_PATTERN = re.compile(r'comment|meta|footer|footnote|页脚|注释|备注', re.IGNORECASE)
+
+    POSITIVE_ATTRS_PATTERN = re.compile(r'post|entry|content|text|body|article', re.IGNORECASE)
+
+    SCORE_TAGS = {'p', 'div'}
+
     def update_token_score(self, t):
-        if not (t.name in {'p', 'div'}):
+        if not (t.name in self.SCORE_TAGS):
             return
         if t.parent == None:
             return
         parent = self.tokens[t.parent]
         if parent.score == 'undefined':
-            parent.score = 0
-            if re.search(r'comment|meta|footer|footnote|页脚|注释|备注', parent.attrs, re.IGNORECASE):
-                parent.score -= 50
-            if re.search(r'post|entry|content|text|body|article', parent.attrs, re.IGNORECASE):
-                parent.score += 25
+            parent.score = self.score_attrs(parent.attrs)
+        tokens = self.tokens
         for i in t.children:
-            child = self.tokens[i]
-            if child.is_text():
+            child = tokens[i]
+            if child.name == TAG_TEXT:
                 parent.score += child.count_sentence()
 
+    def score_attrs(self, attrs):
+        score = 0
+        if attrs:
+            if self.NEGATIVE_ATTRS_PATTERN.search(attrs):
+                score -= 50
+            if self.POSITIVE_ATTRS_PATTERN.search(attrs):
+                score += 25
+        return score
+
     def search_root_token(self):
         self.root = None
         for t in self.tokens:
@@ -272,15 +315,20 @@ class HTMLDumpParser(html.parser.HTMLParser):
 
     def build_token_tree(self):
         stack = [self.root]
+        tokens = self.tokens
+        num_tokens = len(tokens)
         i = self.root.index + 1
-        while i < len(self.tokens):
-            assert(len(stack) > 0)
+        while i < num_tokens:
             top = stack[-1]
-            t = self.tokens[i]
-            if t.is_text():
+            t = tokens[i]
+            name = t.name
+            if name == TAG_TEXT:
                 t.parent = top.index
-                top.children.append(i)    
-            elif t.is_end():
+                if top.children:
+                    top.children.append(i)
+                else:
+                    top.children = [i]
+            elif name[0] == '/':
                 if t.tag == top.tag:
                     top.end_tag_index = i
                     del stack[-1]
@@ -301,7 +349,10 @@ class HTMLDumpParser(html.parser.HTMLParser):
                     break   # root token matched, we are done
             else:
                 t.parent = top.index
-                top.children.append(i)    
+                if top.children:
+                    top.children.append(i)
+                else:
+                    top.children = [i]
                 stack.append(t)
             i += 1
 
@@ -337,8 +388,9 @@ class HTMLDumpParser(html.parser.HTMLParser):
     
     def handle_starttag(self, tag, attrs):
         line_num, line_pos = self.getpos()
-        self.debug_tags.append('<%s> line %d, pos %d, level %d, attr %s' \
-            % (tag, line_num, line_pos, self.tag_level, str(attrs)))
+        if self.debug:
+            self.debug_tags.append('<%s> line %d, pos %d, level %d, attr %s' \
+                % (tag, line_num, line_pos, self.tag_level, str(attrs)))
         self.tag_level += 1
 
         if tag in self.IGNORE_TAGS:
@@ -357,8 +409,9 @@ class HTMLDumpParser(html.parser.HTMLParser):
     def handle_endtag(self, tag):
         self.tag_level -= 1
         line_num, line_pos = self.getpos()
-        self.debug_tags.append('</%s> line %d, pos %d, level %d' \
-            % (tag, line_num, line_pos, self.tag_level))
+        if self.debug:
+            self.debug_tags.append('</%s> line %d, pos %d, level %d' \
+                % (tag, line_num, line_pos, self.tag_level))
 
         if tag in self.IGNORE_TAGS:
             return
@@ -424,6 +477,259 @@ class HTMLDumpParser(html.parser.HTMLParser):
             self.tokens.append(t)
         self.text_chunks = []
 
+##############################################################################
+
+class StreamNode:
+
+    __slots__ = ('tag', 'attrs', 'parent', 'index', 'score', 'num_sentences', \
+                 'empty', 'parent_was_empty', 'texts', 'complete', 'start_pos', 'end_pos')
+
+    def __init__(self, tag, attrs, parent, index, start_pos):
+        self.tag = tag
+        self.attrs = attrs
+        self.parent = parent
+        self.index = index              # 在文档中的顺序, 得分相同时取靠前的
+        self.score = None               # None表示没有p/div子节点, 不参与比较
+        self.num_sentences = 0          # 直接包含的文本中的标点数
+        self.empty = True               # 开始标签之后还没有其它记号
+        self.parent_was_empty = False
+        self.texts = None               # 子树中保留的文本
+        self.complete = True            # False表示子树中有文本被丢弃
+        self.start_pos = start_pos      # 子树在源文本中的范围: 开始标签起点到结束标签起点
+        self.end_pos = None
+
+class HTMLStreamDumpParser(HTMLDumpParser):
+    """流式提取: feed()的同时建树和打分, 不保存记号列表
+
+    只保留打开的节点栈和得分最高的已关闭节点, 节点关闭时即完成打分并释放。
+    节点关闭时文本交给父节点, 但参与打分而没有成为最高分的节点不可能再
+    被选中, 其文本直接丢弃, 父节点标记为不完整; 最终选中的节点不完整时,
+    按记录的位置从源文本中重新提取。
+    <script>, <style>, 导航栏和页脚等子树在解析时直接跳过, 其余规则与
+    HTMLDumpParser相同, 因此这些子树中的文本不会出现在输出中。
+    """
+
+    SKIP_TAGS = {'script', 'style', 'noscript', 'nav', 'footer', 'aside'}
+
+    # id/class为导航栏、页脚等的子树也跳过, 只检查可以包含内容的标签,
+    # 避免跳过的子树因为空标签而永远不结束
+    SKIP_ATTRS_TAGS = {'div', 'ul', 'ol', 'dl', 'table', 'section'}
+
+    SKIP_ATTRS_PATTERN = re.compile(r'(?:^|[\s_-])(?:nav|navbar|footer|sidebar|breadcrumb|copyright)(?:$|[\s_-])', re.IGNORECASE)
+
+    def dump_text(self, text):
+        self.begin(text)
+        self.feed(text)
+        return self.end()
+
+    def begin(self, source):
+        """source为将要feed()的全部文本, 只保存引用, 结束时从中提取正文"""
+        self.reset()
+        self.source = source
+        self.source_line_num = 1
+        self.source_line_start = 0
+        self.text_chunks = [ ]
+        self.texts = None               # 只在重新提取文本时使用
+        self.title_text = ''
+        self.title_state = 0
+        self.title_candidate = ''
+        self.skip_tag = None
+        self.skip_level = 0
+        self.num_nodes = 0
+        self.in_body = False
+        self.done = False
+        self.best = None
+        # virtual document root, replaced by <body> once it shows up
+        self.root = StreamNode(None, '', None, 0, 0)
+        self.stack = [self.root]
+
+    def end(self):
+        self.close()
+        self.flush_text_chunks()
+        end_pos = len(self.source)
+        while self.stack:
+            self._close_node(self.stack.pop(), end_pos)
+        top = self.best or self.root
+        if top.complete:
+            texts = top.texts or [ ]
+        else:
+            texts = self._extract_texts(top)
+        self.body_text = '\n'.join(texts)
+        self.source = None
+        return self.format_text()
+
+    def _extract_texts(self, node):
+        # replay the subtree with the same skipping rules, collecting text only
+        parser = self.__class__()
+        parser.begin(self.source)
+        parser.texts = [ ]
+        parser.feed(self.source[node.start_pos : node.end_pos])
+        parser.close()
+        parser.flush_text_chunks()
+        return parser.texts
+
+    def _source_pos(self):
+        # offset in self.source of the tag being handled, getpos() only goes forward
+        line_num, line_pos = self.getpos()
+        while self.source_line_num < line_num:
+            self.source_line_start = self.source.index('\n', self.source_line_start) + 1
+            self.source_line_num += 1
+        return self.source_line_start + line_pos
+
+    def _format_attrs(self, attrs):
+        return ' '.join([val for key, val in attrs if ((key == 'id') or (key == 'class')) and val])
+
+    def _is_skipped(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            return True
+        if tag in self.SKIP_ATTRS_TAGS:
+            for key, val in attrs:
+                if ((key == 'id') or (key == 'class')) and val and self.SKIP_ATTRS_PATTERN.search(val):
+                    return True
+        return False
+
+    def _track_title(self, name, text=None):
+        if name == 'title':
+            self.title_state = 1
+        elif (name == TAG_TEXT) and (self.title_state == 1):
+            self.title_state = 2
+            self.title_candidate = text
+        else:
+            if (name == '/title') and (self.title_state == 2) and not self.title_text:
+                self.title_text = self.title_candidate
+            self.title_state = 0
+
+    def _close_node(self, node, end_pos):
+        node.end_pos = end_pos
+        parent = node.parent
+        node.parent = None
+        if (parent != None) and (node.tag in self.SCORE_TAGS):
+            if parent.score == None:
+                parent.score = self.score_attrs(parent.attrs)
+            parent.score += node.num_sentences
+        is_best = False
+        if node.score != None:
+            best = self.best
+            if (best == None) or (node.score > best.score) or \
+               ((node.score == best.score) and (node.index < best.index)):
+                self.best = node
+                is_best = True
+        if parent == None:
+            return
+        if (node.score != None) and not is_best:
+            # lost now and never compared again, only an ancestor can still use the text
+            parent.complete = False
+            node.texts = None
+            return
+        if not node.complete:
+            parent.complete = False
+        texts = node.texts
+        if not texts:
+            return
+        if parent.texts == None:
+            # the best node keeps its own list, others hand it over
+            parent.texts = list(texts) if is_best else texts
+        else:
+            parent.texts.extend(texts)
+        if not is_best:
+            node.texts = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if self.skip_level:
+            if tag == self.skip_tag:
+                self.skip_level += 1
+            return
+        if self._is_skipped(tag, attrs):
+            if not (tag in self.IGNORE_TAGS):
+                # a skipped block still separates the text around it
+                self.flush_text_chunks()
+            self.skip_tag = tag
+            self.skip_level = 1
+            return
+        if tag in self.IGNORE_TAGS:
+            return
+        if tag in self.SPACE_TAGS:
+            self.text_chunks.append(' ')
+            return
+
+        self.flush_text_chunks()
+        if self.texts != None:
+            return
+        self.num_nodes += 1
+        self._track_title(tag)
+        if (tag == 'body') and not self.in_body:
+            # everything before <body> is out of the scored tree
+            self.in_body = True
+            self.best = None
+            self.root = StreamNode(tag, self._format_attrs(attrs), None, self.num_nodes, self._source_pos())
+            self.stack = [self.root]
+            return
+        parent = self.stack[-1]
+        node = StreamNode(tag, self._format_attrs(attrs), parent, self.num_nodes, self._source_pos())
+        node.parent_was_empty = parent.empty
+        parent.empty = False
+        self.stack.append(node)
+
+    def handle_endtag(self, tag):
+        if self.done:
+            return
+        if self.skip_level:
+            if tag == self.skip_tag:
+                self.skip_level -= 1
+            return
+        if tag in self.IGNORE_TAGS:
+            return
+        if tag in self.SPACE_TAGS:
+            self.text_chunks.append(' ')
+            return
+
+        self.flush_text_chunks()
+        if self.texts != None:
+            return
+        stack = self.stack
+        top = stack[-1]
+        if (top.tag == tag) and top.empty and (top.parent != None):
+            # discard empty tag pair, as if it never existed
+            del stack[-1]
+            top.parent.empty = top.parent_was_empty
+            self.title_state = 0
+            return
+        self._track_title('/' + tag)
+        top.empty = False
+        if top.tag == tag:
+            del stack[-1]
+            self._close_node(top, self._source_pos())
+        elif (len(stack) >= 2) and (tag == stack[-2].tag):
+            # force close tag
+            end_pos = self._source_pos()
+            self._close_node(stack.pop(), end_pos)
+            self._close_node(stack.pop(), end_pos)
+        if not stack:
+            self.done = True    # root node matched, we are done
+
+    def handle_data(self, text):
+        if text and not (self.skip_level or self.done):
+            self.text_chunks.append(text)
+
+    def flush_text_chunks(self):
+        text = ''.join(self.text_chunks).strip()
+        self.text_chunks = [ ]
+        if (not text) or self.done:
+            return
+        if self.texts != None:
+            self.texts.append(text)
+            return
+        top = self.stack[-1]
+        top.empty = False
+        top.num_sentences += count_sentence(text)
+        if top.texts == None:
+            top.texts = [text]
+        else:
+            top.texts.append(text)
+        self._track_title(TAG_TEXT, text)
+
 if __name__ == '__main__':
     import os
     import sys
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#-------------------------------------------------------------------------
+#
+# 批量提取PageStore输出的 *_page.zip 中网页的标题和正文
+#
+# 网页按条目分组后由多个进程并行解析, 每个进程自行打开zip文件读取网页,
+# 结果按条目顺序写入 <name>_text.zip, 每个网页对应一个 <id>.txt 条目,
+# <id>.url 条目原样复制, <id>.ref 条目改为指向内容相同网页的 .txt 条目。
+# 指定 --stream 时使用流式解析器HTMLStreamDumpParser。
+# .htm 条目注释中保存的HTTP头字符集作为解码时的提示。
+#
+#-------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import zipfile
+import collections
+import concurrent.futures
+
+import html_core_dump
+
+__all__ = ['dump_page_zip']
+
+CFG_CHUNK_SIZE = 64     # 每个任务解析的网页数
+CFG_CHUNK_WINDOW = 4    # 每个工作进程最多积压的已提交任务数
+
+def _dump_chunk(path, names, stream=False):
+    """在工作进程中解析一组网页, 返回(pid, results, num_bytes, elapsed)"""
+    start = time.perf_counter()
+    results = [ ]
+    num_bytes = 0
+    with zipfile.ZipFile(path) as zip_file:
+        for name in names:
+            info = zip_file.getinfo(name)
+            charset = None
+            if info.comment.startswith(b'charset='):
+                charset = info.comment[len(b'charset='):].decode('ascii', errors='ignore')
+            data = zip_file.read(info)
+            num_bytes += len(data)
+            if stream:
+                parser = html_core_dump.HTMLStreamDumpParser()
+            else:
+                parser = html_core_dump.HTMLDumpParser()
+            try:
+                text = parser.dump_raw(data, charset)
+            except Exception:
+                text = None
+            results.append((name, text))
+    return (os.getpid(), results, num_bytes, time.perf_counter() - start)
+
+def dump_page_zip(path, out_path, num_workers=None, stream=False):
+    """提取path中全部网页的标题和正文写入out_path, 返回各工作进程的统计信息"""
+    with zipfile.ZipFile(path) as zip_file:
+        names = zip_file.namelist()
+    pages = [n for n in names if n.endswith('.htm')]
+    chunks = [pages[i:i+CFG_CHUNK_SIZE] for i in range(0, len(pages), CFG_CHUNK_SIZE)]
+    num_workers = num_workers or os.cpu_count() or 1
+
+    stats = { }     # key:pid, value:[pages, failed, bytes, seconds]
+    texts = set()   # 已写入的 .txt 条目名
+    with zipfile.ZipFile(out_path, mode='w', compression=zipfile.ZIP_DEFLATED) as out_file:
+        def write_chunk(future):
+            pid, results, num_bytes, elapsed = future.result()
+            item = stats.setdefault(pid, [0, 0, 0, 0.0])
+            item[0] += len(results)
+            item[2] += num_bytes
+            item[3] += elapsed
+            for name, text in results:
+                if text == None:
+                    item[1] += 1
+                else:
+                    name = name[:-len('.htm')] + '.txt'
+                    out_file.writestr(name, text)
+                    texts.add(name)
+
+        # chunks are written in order as soon as they are done, only a
+        # bounded window of submitted chunks is kept in memory
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+            window = collections.deque()
+            for chunk in chunks:
+                window.append(executor.submit(_dump_chunk, path, chunk, stream))
+                while window and ((len(window) >= num_workers * CFG_CHUNK_WINDOW) or window[0].done()):
+                    write_chunk(window.popleft())
+            while window:
+                write_chunk(window.popleft())
+
+        with zipfile.ZipFile(path) as zip_file:
+            for name in names:
+                if name.endswith('.url'):
+                    out_file.writestr(name, zip_file.read(name))
+                elif name.endswith('.ref'):
+                    ref_name = zip_file.read(name).decode('ascii', errors='ignore').strip()
+                    ref_name = ref_name[:-len('.htm')] + '.txt'
+                    # the referenced page failed to dump, nothing to point at
+                    if ref_name in texts:
+                        out_file.writestr(name, ref_name.encode('ascii'))
+    return stats
+
+if __name__ == '__main__':
+
+    args = sys.argv[1:]
+    stream = False
+    if args and (args[0] == '--stream'):
+        stream = True
+        args = args[1:]
+    if len(args) not in (1, 2):
+        print('usage: html_zip_dump [--stream] page_zip_file [num_workers]')
+        sys.exit(0)
+
+    page_file = args[0]
+    if not os.path.isfile(page_file):
+        print('Error: file not found')
+        sys.exit(1)
+    num_workers = None
+    if len(args) == 2:
+        num_workers = int(args[1])
+
+    root, ext = os.path.splitext(page_file)
+    if root.endswith('_page'):
+        root = root[:-len('_page')]
+    text_file = root + '_text.zip'
+
+    start = time.perf_counter()
+    stats = dump_page_zip(page_file, text_file, num_workers, stream)
+    elapsed = time.perf_counter() - start
+
+    total = [0, 0, 0]
+    for pid, (pages, failed, num_bytes, seconds) in sorted(stats.items()):
+        seconds = max(seconds, 1e-6)
+        print('worker %d: %d pages, %d failed, %.1f pages/s, %.2f MB/s' % \
+              (pid, pages, failed, pages / seconds, num_bytes / seconds / 1048576))
+        total[0] += pages
+        total[1] += failed
+        total[2] += num_bytes
+    elapsed = max(elapsed, 1e-6)
+    print('total: %d pages, %d failed, %.1f pages/s, %.2f MB/s, %.1f s' % \
+          (total[0], total[1], total[0] / elapsed, total[2] / elapsed / 1048576, elapsed))
+    print('save file %s' % text_file)